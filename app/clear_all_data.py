@@ -1,31 +1,28 @@
 import logging
-from db_utils import get_db_connection
+from db_utils import db_conn, initialize_db
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
 def clear_all_tables():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        logger.info("⚠️  Deleting all rows from tables...")
-        
-        # Delete in dependency order to satisfy FK constraints
-        cursor.execute("DELETE FROM deployment_prs;")
-        cursor.execute("DELETE FROM incidents;")
-        cursor.execute("DELETE FROM pull_requests;")
-        cursor.execute("DELETE FROM deployments;")
-        cursor.execute("DELETE FROM dora_metrics;")
-        
-        conn.commit()
-        logger.info("✅ All tables cleared successfully.")
-    except Exception as e:
-        logger.error(f"❌ Failed to clear tables: {e}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+    with db_conn() as conn:
+        cursor = conn.cursor()
+        try:
+            logger.info("⚠️  Truncating all tables...")
+            
+            # CASCADE covers the FK dependencies, so no deletion order is needed
+            cursor.execute("TRUNCATE TABLE deployment_prs, incidents, pull_requests, deployments, dora_metrics, repositories RESTART IDENTITY CASCADE;")
+            
+            conn.commit()
+            logger.info("✅ All tables cleared successfully.")
+        except Exception as e:
+            logger.error(f"❌ Failed to clear tables: {e}")
+            conn.rollback()
+        finally:
+            cursor.close()
 
 if __name__ == "__main__":
+    # Creates repositories on a database from before it existed, so the TRUNCATE below can name it
+    initialize_db()
     clear_all_tables()
@@ -1,21 +1,117 @@
 import os
+import io
+import re
+import atexit
+import weakref
+import threading
 import psycopg2
+import psycopg2.pool
+from contextlib import contextmanager
 from dotenv import load_dotenv
 import logging
 import psycopg2.errors
+from dora_calculations import PRODUCTION_ENVIRONMENT_PATTERN, PRODUCTION_WORKFLOW_PATTERN
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+# Production classification stored by Postgres; mirrors detect_production_deployment
+IS_PROD_COLUMN = f"""is_prod BOOLEAN GENERATED ALWAYS AS (
+    COALESCE(environment, '') ~* '{PRODUCTION_ENVIRONMENT_PATTERN}' OR
+    COALESCE(payload->'workflow_run'->>'name', '') ~* '{PRODUCTION_WORKFLOW_PATTERN}'
+) STORED"""
+
+# UTC day of each deployment, indexed so per-day filters compare 4-byte dates instead of timestamps
+CREATED_DATE_COLUMN = "created_date DATE GENERATED ALWAYS AS ((created_at AT TIME ZONE 'UTC')::date) STORED"
+
+# Source tables whose writes change the computed metrics
+ACTIVITY_TABLES = ('deployments', 'pull_requests', 'incidents')
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def _get_pool():
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = psycopg2.pool.ThreadedConnectionPool(
+                    # putconn closes any connection returned while minconn are already idle, so this
+                    # is also how many connections the pool keeps open between bursts
+                    minconn=int(os.getenv('DB_POOL_MIN', '5')),
+                    maxconn=int(os.getenv('DB_POOL_MAX', '20')),
+                    dbname=os.getenv('DB_NAME'),
+                    user=os.getenv('DB_USER'),
+                    password=os.getenv('DB_PASSWORD'),
+                    host=os.getenv('DB_HOST'),
+                    port=os.getenv('DB_PORT'),
+                    sslmode='require',
+                    # Keep idle pooled connections from being dropped by the server or a NAT in between
+                    keepalives=1,
+                    keepalives_idle=30
+                )
+    return _POOL
+
 def get_db_connection():
-    return psycopg2.connect(
-        dbname=os.getenv('DB_NAME'),
-        user=os.getenv('DB_USER'),
-        password=os.getenv('DB_PASSWORD'),
-        host=os.getenv('DB_HOST'),
-        port=os.getenv('DB_PORT'),
-        sslmode='require'
-    )
+    """Borrow a connection from the pool; hand it back with release_db_connection"""
+    return _get_pool().getconn()
+
+def release_db_connection(conn):
+    _get_pool().putconn(conn)
+
+@contextmanager
+def db_conn():
+    conn = get_db_connection()
+    try:
+        yield conn
+    finally:
+        release_db_connection(conn)
+
+@atexit.register
+def _close_pool():
+    if _POOL is not None:
+        _POOL.closeall()
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def create_staging_table(cursor, table, columns):
+    cursor.execute(f"""
+        CREATE TEMP TABLE {table}_stage ON COMMIT DROP AS
+        SELECT {', '.join(columns)} FROM {table} WITH NO DATA
+    """)
+
+def stage_rows(cursor, table, columns, rows):
+    """Stream rows into the table's staging copy with COPY instead of INSERT"""
+    if not rows:
+        return
+    buffer = io.StringIO(''.join('\t'.join(_copy_value(v) for v in row) + '\n' for row in rows))
+    cursor.copy_expert(f"COPY {table}_stage ({', '.join(columns)}) FROM STDIN", buffer)
+
+# Opt-in: PREPARE only pays off when the pool keeps connections long enough to reuse them (DB_POOL_MIN covers
+# the usual concurrency), and a transaction-mode pooler (e.g. Supabase on 6543) cannot keep them at all
+USE_PREPARED_STATEMENTS = os.getenv('DB_PREPARED_STATEMENTS', '0') == '1'
+_PREPARED = weakref.WeakKeyDictionary()
+
+def execute_prepared(cursor, name, statement, params):
+    """Run statement (written with $1..$n placeholders) as a server-side prepared statement
+
+    Each pooled connection parses and plans it once, on first use; later calls only send EXECUTE.
+    """
+    if not USE_PREPARED_STATEMENTS:
+        cursor.execute(
+            re.sub(r'\$(\d+)', r'%(p\1)s', statement),
+            {f'p{i}': value for i, value in enumerate(params, start=1)}
+        )
+        return
+    prepared = _PREPARED.setdefault(cursor.connection, set())
+    if name not in prepared:
+        # Prepared statements belong to the session, not the transaction, so a later rollback keeps them
+        cursor.execute(f"PREPARE {name} AS {statement}")
+        prepared.add(name)
+    cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
 
 def drop_existing_tables(cursor):
     tables = [
@@ -23,7 +119,9 @@ def drop_existing_tables(cursor):
         'incidents',
         'pull_requests',
         'deployments',
-        'dora_metrics'
+        'dora_metrics',
+        'repositories',
+        'metric_jobs'
     ]
     for table in tables:
         try:
@@ -41,7 +139,8 @@ def initialize_db():
         cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'public'")
         existing_tables = {row[0] for row in cursor.fetchall()}
         expected_tables = {
-            'deployments', 'pull_requests', 'incidents', 'deployment_prs', 'dora_metrics', 'sync_state'
+            'deployments', 'pull_requests', 'incidents', 'deployment_prs', 'dora_metrics', 'sync_state',
+            'repositories', 'metric_jobs'
         }
 
         if not expected_tables.issubset(existing_tables):
@@ -61,7 +160,11 @@ def initialize_db():
                 print("Aborting initialization.")
                 exit(1)
         else:
-            logger.info("Tables already exist. No changes made.")
+            # Column and index upgrades are idempotent, so databases created by older versions catch up
+            _upgrade_schema(cursor)
+            _create_indexes(cursor)
+            conn.commit()
+            logger.info("Tables already exist. Schema is up to date.")
 
     except Exception as e:
         logger.error(f"Initialization failed: {e}")
@@ -69,11 +172,11 @@ def initialize_db():
         raise
     finally:
         cursor.close()
-        conn.close()
+        release_db_connection(conn)
 
 def _create_tables(cursor):
     # deployments table
-    cursor.execute("""
+    cursor.execute(f"""
         CREATE TABLE IF NOT EXISTS deployments (
             id SERIAL PRIMARY KEY,
             repo_id BIGINT NOT NULL,
@@ -82,7 +185,10 @@ def _create_tables(cursor):
             status TEXT,
             created_at TIMESTAMPTZ NOT NULL,
             commit_sha TEXT,
-            payload JSONB
+            payload JSONB,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            {IS_PROD_COLUMN},
+            {CREATED_DATE_COLUMN}
         );
     """)
 
@@ -98,7 +204,8 @@ def _create_tables(cursor):
             first_commit_at TIMESTAMPTZ,
             base_branch TEXT,
             commit_sha TEXT,
-            payload JSONB
+            payload JSONB,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
         );
     """)
 
@@ -112,7 +219,8 @@ def _create_tables(cursor):
             closed_at TIMESTAMPTZ,
             is_incident BOOLEAN DEFAULT FALSE,
             deployment_id BIGINT REFERENCES deployments(deployment_id) ON DELETE SET NULL,
-            payload JSONB
+            payload JSONB,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
         );
     """)
 
@@ -154,12 +262,140 @@ def _create_tables(cursor):
         ON CONFLICT DO NOTHING;
     """)
 
+    _upgrade_schema(cursor)
+    _create_indexes(cursor)
+
+def _upgrade_schema(cursor):
+    cursor.execute(f"ALTER TABLE deployments ADD COLUMN IF NOT EXISTS {IS_PROD_COLUMN};")
+    cursor.execute(f"ALTER TABLE deployments ADD COLUMN IF NOT EXISTS {CREATED_DATE_COLUMN};")
+    # Newest source-row updated_at the metrics job had seen when it computed the row; NULL until a full run writes it
+    cursor.execute("ALTER TABLE dora_metrics ADD COLUMN IF NOT EXISTS source_updated_at TIMESTAMPTZ;")
+
+    # updated_at records the last write to each source row so the metrics job can skip idle repos.
+    # A trigger keeps it current for every writer (webhooks, backfill, fix-up scripts) without touching their SQL.
+    cursor.execute("""
+        CREATE OR REPLACE FUNCTION set_updated_at() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at = NOW();
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    for table in ACTIVITY_TABLES:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW();")
+        cursor.execute(f"DROP TRIGGER IF EXISTS trg_{table}_updated_at ON {table};")
+        cursor.execute(f"""
+            CREATE TRIGGER trg_{table}_updated_at
+            BEFORE UPDATE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+        """)
+
+    # Linking a PR changes its deployment's lead time, so the link marks the deployment as written;
+    # this catches every linker (webhooks, backfill merges, fix_data_links) without touching their SQL
+    cursor.execute("""
+        CREATE OR REPLACE FUNCTION touch_linked_deployments() RETURNS trigger AS $$
+        BEGIN
+            UPDATE deployments SET updated_at = NOW()
+            WHERE deployment_id IN (SELECT deployment_id FROM new_rows);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    cursor.execute("DROP TRIGGER IF EXISTS trg_deployment_prs_touch ON deployment_prs;")
+    cursor.execute("""
+        CREATE TRIGGER trg_deployment_prs_touch
+        AFTER INSERT ON deployment_prs
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION touch_linked_deployments();
+    """)
+
+    # repositories table: one row per repo seen in any source table, kept by trigger
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS repositories (
+            repo_id BIGINT PRIMARY KEY
+        );
+    """)
+    # Statement-level, so a bulk backfill merge registers its repos in one INSERT rather than one per row
+    cursor.execute("""
+        CREATE OR REPLACE FUNCTION register_repositories() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO repositories (repo_id)
+            SELECT DISTINCT repo_id FROM new_rows
+            ON CONFLICT DO NOTHING;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    for table in ACTIVITY_TABLES:
+        cursor.execute(f"DROP TRIGGER IF EXISTS trg_{table}_repositories ON {table};")
+        cursor.execute(f"""
+            CREATE TRIGGER trg_{table}_repositories
+            AFTER INSERT ON {table}
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION register_repositories();
+        """)
+    # Seed once from rows written before the table existed
+    cursor.execute("""
+        INSERT INTO repositories (repo_id)
+        SELECT repo_id FROM (
+            SELECT repo_id FROM deployments
+            UNION
+            SELECT repo_id FROM pull_requests
+            UNION
+            SELECT repo_id FROM incidents
+        ) AS seen
+        WHERE NOT EXISTS (SELECT 1 FROM repositories)
+        ON CONFLICT DO NOTHING;
+    """)
+
+    # metric_jobs table: status of /calculate runs, readable from any server worker
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS metric_jobs (
+            id SERIAL PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'queued',
+            requested_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            finished_at TIMESTAMPTZ,
+            processed INT,
+            error TEXT
+        );
+    """)
+    # At most one queued/running job across every server worker; older duplicates are retired so the index can build
+    cursor.execute("""
+        UPDATE metric_jobs SET status = 'failed', error = 'superseded', finished_at = NOW()
+        WHERE status IN ('queued', 'running') AND
+              id < (SELECT MAX(id) FROM metric_jobs WHERE status IN ('queued', 'running'));
+    """)
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_metric_jobs_active
+        ON metric_jobs ((TRUE)) WHERE status IN ('queued', 'running');
+    """)
+
+def _create_indexes(cursor):
     # indexes for performance
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_deployments_repo ON deployments(repo_id);")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_prs_repo ON pull_requests(repo_id);")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_incidents_repo ON incidents(repo_id);")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_metrics_repo_date ON dora_metrics(repo_id, metric_date);")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_deployment_prs ON deployment_prs(deployment_id, pr_id);")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_deployments_sha ON deployments(commit_sha);")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_prs_sha ON pull_requests(commit_sha);")
+    # PR/deployment links always match within a repo; the composite indexes supersede the sha-only ones
+    cursor.execute("DROP INDEX IF EXISTS idx_deployments_sha;")
+    cursor.execute("DROP INDEX IF EXISTS idx_prs_sha;")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_deployments_repo_sha ON deployments(repo_id, commit_sha);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_prs_repo_sha ON pull_requests(repo_id, commit_sha);")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_metrics_updated ON dora_metrics(last_updated);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_incidents_deployment ON incidents(deployment_id);")
+    # Issues stored with is_incident = FALSE (label-classified by the extras webhook processor) never count toward MTTR
+    cursor.execute("DROP INDEX IF EXISTS idx_incidents_repo_closed;")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_incidents_repo_closed_incident ON incidents(repo_id, closed_at) WHERE is_incident = TRUE AND closed_at IS NOT NULL;")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_deployment_prs_pr ON deployment_prs(pr_id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_deployments_repo_created ON deployments(repo_id, created_at DESC);")
+    # Every metrics query now scans deployments by created_date, so the prod-only (repo_id, created_at) index is dead weight;
+    # failures count deployments of every status, so the day index is not partial on status
+    cursor.execute("DROP INDEX IF EXISTS idx_deployments_prod;")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_deployments_repo_day ON deployments(repo_id, created_date);")
+    # Expression must be immutable to be indexed, so days are bucketed in UTC rather than the session time zone
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_incidents_repo_day
+        ON incidents(repo_id, ((created_at AT TIME ZONE 'UTC')::date))
+        WHERE is_incident = TRUE AND closed_at IS NOT NULL;
+    """)
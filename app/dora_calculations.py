@@ -1,47 +1,39 @@
 from datetime import datetime, timedelta
 import math
+import re
 import logging
 
 logger = logging.getLogger(__name__)
 
-def calculate_lead_time(first_commit, merged_at, deploy_time):
-    if not merged_at:
-        return max((deploy_time - first_commit).total_seconds() / 3600, 0.1)
-    if deploy_time < merged_at:
-        return max((deploy_time - first_commit).total_seconds() / 3600, 0.1)
-    return (deploy_time - first_commit).total_seconds() / 3600
+PRODUCTION_ENVIRONMENT_PATTERN = r'prod|production|live'
+PRODUCTION_WORKFLOW_PATTERN = r'deploy|prod|release'
+_PROD_ENV_RE = re.compile(PRODUCTION_ENVIRONMENT_PATTERN, re.I)
+_PROD_WORKFLOW_RE = re.compile(PRODUCTION_WORKFLOW_PATTERN, re.I)
+INCIDENT_LABEL_PATTERN = r'incident|outage|failure|sev'
+_INCIDENT_LABEL_RE = re.compile(INCIDENT_LABEL_PATTERN, re.I)
+
+def parse_github_timestamp(value):
+    """Parse a GitHub ISO-8601 timestamp ('2024-01-02T03:04:05Z') into an aware UTC datetime"""
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
 
 def calculate_failure_rate(total_deployments, failed_deployments):
     if total_deployments == 0:
         return 0.0
     return (failed_deployments / total_deployments) * 100
 
-def calculate_mttr(created_at, closed_at):
-    if not closed_at or closed_at < created_at:
-        return 0.0
-    return (closed_at - created_at).total_seconds() / 3600
-
-def median(values):
-    if not values:
-        return 0.0
-    sorted_vals = sorted(values)
-    n = len(sorted_vals)
-    mid = n // 2
-    if n % 2 == 0:
-        return (sorted_vals[mid - 1] + sorted_vals[mid]) / 2
-    return sorted_vals[mid]
-
 def detect_production_deployment(environment, payload):
     try:
-        env = environment.lower() if environment else ''
-        if any(term in env for term in ['prod', 'production', 'live']):
+        if _PROD_ENV_RE.search(environment or ''):
             return True
 
         workflow_run = payload.get('workflow_run', {}) if payload else {}
-        workflow_name = workflow_run.get('name', '').lower()
-        if any(term in workflow_name for term in ['deploy', 'prod', 'release']):
+        workflow_name = workflow_run.get('name', '')
+        if _PROD_WORKFLOW_RE.search(workflow_name or ''):
             return True
     except Exception as e:
         logger.warning(f"Error detecting production deployment: {e}")
     return False
 
+def is_incident_issue(labels):
+    """True if any GitHub label name contains an incident term (substring, case-insensitive)"""
+    return any(_INCIDENT_LABEL_RE.search(label.get('name') or '') for label in labels or [])
@@ -1,15 +1,47 @@
 # github_auth.py
 import os
+import hmac
+import hashlib
 import jwt
 import time
+import threading
 import requests
+from datetime import datetime
+from functools import lru_cache
 
-def generate_jwt():
-    app_id = os.getenv("GITHUB_APP_ID")
-    private_key_path = os.getenv("GITHUB_PRIVATE_KEY_PATH")
+# Refresh installation tokens this long before GitHub's expires_at
+TOKEN_REFRESH_MARGIN_SECONDS = 60
+# (connect, read); the mint runs under _TOKEN_LOCK, so a hung call would stall every thread waiting on a token
+TOKEN_REQUEST_TIMEOUT = (3.05, 10)
+
+_TOKEN_CACHE = {'token': None, 'exp': 0}
+_TOKEN_LOCK = threading.Lock()
 
+@lru_cache(maxsize=1)
+def _load_private_key(private_key_path):
     with open(private_key_path, "r") as f:
-        private_key = f.read()
+        return f.read()
+
+@lru_cache(maxsize=1)
+def _webhook_secret():
+    # Read on first use rather than at import, once the caller has loaded .env
+    return (os.getenv('GITHUB_WEBHOOK_SECRET') or '').encode()
+
+def verify_webhook_signature(payload_body, signature_header):
+    """Check GitHub's X-Hub-Signature-256 header against the HMAC of the raw request body"""
+    secret = _webhook_secret()
+    if not secret or not signature_header or not signature_header.startswith('sha256='):
+        return False
+    try:
+        signature = bytes.fromhex(signature_header[len('sha256='):])
+    except ValueError:
+        return False
+    expected_signature = hmac.new(secret, msg=payload_body, digestmod=hashlib.sha256).digest()
+    return hmac.compare_digest(expected_signature, signature)
+
+def generate_jwt():
+    app_id = os.getenv("GITHUB_APP_ID")
+    private_key = _load_private_key(os.getenv("GITHUB_PRIVATE_KEY_PATH"))
 
     payload = {
         'iat': int(time.time()) - 60,
@@ -21,15 +53,30 @@ def generate_jwt():
     return token
 
 def get_installation_token():
-    jwt_token = generate_jwt()
-    installation_id = os.getenv("GITHUB_INSTALLATION_ID")
+    """Return a cached installation token, minting a new one shortly before it expires"""
+    with _TOKEN_LOCK:
+        if _TOKEN_CACHE['token'] and _TOKEN_CACHE['exp'] - time.time() > TOKEN_REFRESH_MARGIN_SECONDS:
+            return _TOKEN_CACHE['token']
 
-    headers = {
-        "Authorization": f"Bearer {jwt_token}",
-        "Accept": "application/vnd.github+json"
-    }
+        jwt_token = generate_jwt()
+        installation_id = os.getenv("GITHUB_INSTALLATION_ID")
+
+        headers = {
+            "Authorization": f"Bearer {jwt_token}",
+            "Accept": "application/vnd.github+json"
+        }
+
+        url = f"https://api.github.com/app/installations/{installation_id}/access_tokens"
+        response = requests.post(url, headers=headers, timeout=TOKEN_REQUEST_TIMEOUT)
+        response.raise_for_status()
+        data = response.json()
+
+        _TOKEN_CACHE['token'] = data["token"]
+        _TOKEN_CACHE['exp'] = datetime.fromisoformat(data["expires_at"].replace('Z', '+00:00')).timestamp()
+        return _TOKEN_CACHE['token']
 
-    url = f"https://api.github.com/app/installations/{installation_id}/access_tokens"
-    response = requests.post(url, headers=headers)
-    response.raise_for_status()
-    return response.json()["token"]
+def invalidate_installation_token():
+    """Drop the cached token so the next call mints a fresh one (e.g. after a 401)"""
+    with _TOKEN_LOCK:
+        _TOKEN_CACHE['token'] = None
+        _TOKEN_CACHE['exp'] = 0
@@ -1,225 +1,343 @@
 import os
 import json
 import requests
-from datetime import datetime
-from db_utils import get_db_connection
-from github_auth import get_installation_token 
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import datetime, timedelta
+from db_utils import db_conn, create_staging_table, stage_rows
+from github_auth import get_installation_token, invalidate_installation_token
+from dora_calculations import parse_github_timestamp
 from datetime import timezone , datetime
 
 GITHUB_REPO = os.getenv("GITHUB_REPO")
-
-def github_get(url):
+PR_COLUMNS = (
+    'repo_id', 'pr_id', 'merged_at', 'created_at', 'first_commit_at',
+    'base_branch', 'commit_sha', 'pr_name', 'payload'
+)
+DEPLOYMENT_COLUMNS = ('repo_id', 'deployment_id', 'environment', 'status', 'created_at', 'commit_sha', 'payload')
+INCIDENT_COLUMNS = ('repo_id', 'issue_id', 'created_at', 'closed_at', 'is_incident', 'payload')
+MAX_WORKERS = 16
+GRAPHQL_URL = "https://api.github.com/graphql"
+GRAPHQL_PR_BATCH = 50
+
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 502, 503, 504])
+))
+
+def _github_request(method, url, _retried=False, extra_headers=None, **kwargs):
     token = get_installation_token()
     headers = {
         "Authorization": f"Bearer {token}",
-        "Accept": "application/vnd.github+json"
+        "Accept": "application/vnd.github+json",
+        **(extra_headers or {})
     }
-    return requests.get(url, headers=headers, timeout=10)
-
-def insert_pull_request(cursor, pr, repo_id):
+    response = SESSION.request(method, url, headers=headers, timeout=10, **kwargs)
+    if response.status_code == 401 and not _retried:
+        # Token was revoked or expired early; mint a fresh one and retry once
+        invalidate_installation_token()
+        return _github_request(method, url, _retried=True, extra_headers=extra_headers, **kwargs)
+    return response
+
+def github_get(url, **kwargs):
+    return _github_request('GET', url, **kwargs)
+
+def github_post(url, **kwargs):
+    return _github_request('POST', url, **kwargs)
+
+def fetch_first_commit_dates(pr_numbers):
+    """Return {pr_number: earliest commit author date} for a batch of PRs using one GraphQL request"""
+    owner, name = GITHUB_REPO.split('/', 1)
+    # One aliased pullRequest field per PR replaces one REST commits call per PR
+    fields = '\n'.join(
+        f"pr{number}: pullRequest(number: {number}) {{ commits(first: 100) {{ nodes {{ commit {{ authoredDate }} }} }} }}"
+        for number in pr_numbers
+    )
+    query = f"query($owner: String!, $name: String!) {{ repository(owner: $owner, name: $name) {{ {fields} }} }}"
+    try:
+        response = github_post(GRAPHQL_URL, json={"query": query, "variables": {"owner": owner, "name": name}})
+        response.raise_for_status()
+    except requests.RequestException as e:
+        # Like GraphQL-level errors, a failed batch falls back to created_at for its PRs rather than aborting the backfill
+        print(f"\n First-commit lookup failed for {len(pr_numbers)} PRs: {e}")
+        return {}
+    repository = (response.json().get('data') or {}).get('repository') or {}
+
+    first_commits = {}
+    for number in pr_numbers:
+        nodes = ((repository.get(f"pr{number}") or {}).get('commits') or {}).get('nodes') or []
+        dates = [parse_github_timestamp(n['commit']['authoredDate']) for n in nodes if n.get('commit', {}).get('authoredDate')]
+        if dates:
+            first_commits[number] = min(dates)
+    return first_commits
+
+# Row builders keep GitHub's ISO-8601 strings as-is; COPY parses them into the TIMESTAMPTZ columns
+def pull_request_row(pr, repo_id, first_commit_at=None):
     pr_id = pr['id']
-    created_at = datetime.strptime(pr['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-    merged_at = datetime.strptime(pr['merged_at'], '%Y-%m-%dT%H:%M:%SZ') if pr.get('merged_at') else None
+    created_at = pr['created_at']
+    merged_at = pr.get('merged_at')
     commit_sha = pr.get('merge_commit_sha', '')
     base_branch = pr['base']['ref']
     pr_name = pr.get('title', '')
-
-    commits_url = pr['_links']['commits']['href']
-    commits_resp = github_get(commits_url)
-    commits = commits_resp.json()
-
-    if commits and isinstance(commits, list):
-        first_commit_at = min(
-            datetime.strptime(c['commit']['author']['date'], '%Y-%m-%dT%H:%M:%SZ')
-            for c in commits
-        )
-    else:
-        first_commit_at = created_at
+    first_commit_at = first_commit_at or created_at
 
     payload = json.dumps({"pull_request": pr})
+    return (repo_id, pr_id, merged_at, created_at, first_commit_at, base_branch, commit_sha, pr_name, payload)
 
-    cursor.execute("""
-        INSERT INTO pull_requests 
-            (repo_id, pr_id, merged_at, created_at, first_commit_at, base_branch, commit_sha, pr_name, payload)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (pr_id) DO UPDATE SET
-            merged_at = EXCLUDED.merged_at,
-            commit_sha = EXCLUDED.commit_sha,
-            pr_name = EXCLUDED.pr_name,
-            first_commit_at = EXCLUDED.first_commit_at,
-            payload = EXCLUDED.payload
-    """, (repo_id, pr_id, merged_at, created_at, first_commit_at, base_branch, commit_sha, pr_name, payload))
-
-def insert_deployment(cursor, deployment, status, repo_id):
+def deployment_row(deployment, status, repo_id):
     deployment_id = deployment['id']
     environment = deployment.get('environment', '')
     state = status['state']
-    created_at = datetime.strptime(status['created_at'], '%Y-%m-%dT%H:%M:%SZ')
+    created_at = status['created_at']
     commit_sha = deployment.get('sha', '')
     payload = json.dumps({"deployment": deployment, "deployment_status": status})
-    cursor.execute("""
-        INSERT INTO deployments 
-            (repo_id, deployment_id, environment, status, created_at, commit_sha, payload)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (deployment_id) DO UPDATE SET
-            status = EXCLUDED.status,
-            payload = EXCLUDED.payload
-    """, (repo_id, deployment_id, environment, state, created_at, commit_sha, payload))
+    return (repo_id, deployment_id, environment, state, created_at, commit_sha, payload)
 
-def insert_incident(cursor, issue, repo_id):
+def incident_row(issue, repo_id):
     issue_id = issue['id']
-    created_at = datetime.strptime(issue['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-    closed_at = datetime.strptime(issue['closed_at'], '%Y-%m-%dT%H:%M:%SZ') if issue.get('closed_at') else None
-    labels = [l['name'].lower() for l in issue.get('labels', [])]
+    created_at = issue['created_at']
+    closed_at = issue.get('closed_at')
     is_incident = True
     payload = json.dumps({"issue": issue})
-    cursor.execute("""
-        INSERT INTO incidents 
-            (repo_id, issue_id, created_at, closed_at, is_incident, payload)
-        VALUES (%s, %s, %s, %s, %s, %s)
+    return (repo_id, issue_id, created_at, closed_at, is_incident, payload)
+
+# A row can be staged twice if it is updated while we paginate; keep its newest version.
+# Rows whose GitHub updated_at is unchanged are skipped so they cost no WAL or index writes.
+def merge_pull_requests(cursor):
+    columns = ', '.join(PR_COLUMNS)
+    cursor.execute(f"""
+        INSERT INTO pull_requests ({columns})
+        SELECT DISTINCT ON (pr_id) {columns}
+        FROM pull_requests_stage
+        ORDER BY pr_id, payload->'pull_request'->>'updated_at' DESC
+        ON CONFLICT (pr_id) DO UPDATE SET
+            merged_at = EXCLUDED.merged_at,
+            commit_sha = EXCLUDED.commit_sha,
+            pr_name = EXCLUDED.pr_name,
+            first_commit_at = EXCLUDED.first_commit_at,
+            payload = EXCLUDED.payload
+        WHERE pull_requests.payload->'pull_request'->>'updated_at'
+            IS DISTINCT FROM EXCLUDED.payload->'pull_request'->>'updated_at'
+    """)
+
+def merge_deployments(cursor):
+    columns = ', '.join(DEPLOYMENT_COLUMNS)
+    cursor.execute(f"""
+        INSERT INTO deployments ({columns})
+        SELECT DISTINCT ON (deployment_id) {columns}
+        FROM deployments_stage
+        ORDER BY deployment_id, created_at DESC
+        ON CONFLICT (deployment_id) DO UPDATE SET
+            status = EXCLUDED.status,
+            payload = EXCLUDED.payload
+        WHERE deployments.payload->'deployment_status'->>'updated_at'
+            IS DISTINCT FROM EXCLUDED.payload->'deployment_status'->>'updated_at'
+    """)
+
+def merge_incidents(cursor):
+    columns = ', '.join(INCIDENT_COLUMNS)
+    cursor.execute(f"""
+        INSERT INTO incidents ({columns})
+        SELECT DISTINCT ON (issue_id) {columns}
+        FROM incidents_stage
+        ORDER BY issue_id, payload->'issue'->>'updated_at' DESC
         ON CONFLICT (issue_id) DO UPDATE SET
             closed_at = EXCLUDED.closed_at,
             is_incident = EXCLUDED.is_incident,
             payload = EXCLUDED.payload
-    """, (repo_id, issue_id, created_at, closed_at, is_incident, payload))
+        WHERE incidents.payload->'issue'->>'updated_at'
+            IS DISTINCT FROM EXCLUDED.payload->'issue'->>'updated_at'
+    """)
+
+def month_windows(start, end):
+    """Yield [window_start, window_end) month boundaries covering start..end"""
+    if not start or not end:
+        return
+    window_start = start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    while window_start <= end:
+        window_end = (window_start + timedelta(days=32)).replace(day=1)
+        yield window_start, window_end
+        window_start = window_end
 
 def backfill():
     """Backfill GitHub data including PRs, deployments, incidents, and their relationships"""
-    conn = None
-    try:
-        conn = get_db_connection()
+    with db_conn() as conn, ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
         cursor = conn.cursor()
-
-        cursor.execute("SELECT last_webhook_at FROM sync_state WHERE id = 1")
-        row = cursor.fetchone()
-        last_webhook_at = row[0] if row and row[0] else None
-        print(f" Last webhook received at: {last_webhook_at}")
-
-        print(f" Fetching repository details for {GITHUB_REPO}...")
-        repo_data = github_get(f"https://api.github.com/repos/{GITHUB_REPO}").json()
-        if 'id' not in repo_data:
-            raise ValueError(f"Could not fetch repo data: {repo_data.get('message', 'Unknown error')}")
-
-        repo_id = repo_data['id']
-        print(f" Repository ID: {repo_id}")
-
-        print("\n Fetching Pull Requests...")
-        pr_count = 0
-        url = f"https://api.github.com/repos/{GITHUB_REPO}/pulls?state=closed&sort=updated&direction=asc&per_page=100"
-        while url:
-            response = github_get(url)
-            response.raise_for_status()
-            prs = response.json()
-
-            for pr in prs:
-                updated_at = datetime.strptime(pr['updated_at'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
-                if last_webhook_at and updated_at <= last_webhook_at:
-                    continue  
-
-                if pr.get('merged_at'):  
-                    insert_pull_request(cursor, pr, repo_id)
-                    pr_count += 1
-
-            print(f" Processed {pr_count} PRs so far...", end='\r')
-            url = response.links.get('next', {}).get('url')
-        print(f"\n Processed {pr_count} total PRs")
-
-        print("\n Fetching Deployments...")
-        deployment_count = 0
-        url = f"https://api.github.com/repos/{GITHUB_REPO}/deployments?per_page=100"
-        while url:
-            response = github_get(url)
-            response.raise_for_status()
-            deployments = response.json()
-
-            for deployment in deployments:
-                statuses = github_get(deployment['statuses_url']).json()
-                success_status = next((s for s in statuses if s['state'] == 'success'), None)
-
-                if success_status:
-                    created_at = datetime.strptime(success_status['created_at'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
-                    if last_webhook_at and created_at <= last_webhook_at:
-                        continue  # Skip old deployments
-
-                    insert_deployment(cursor, deployment, success_status, repo_id)
-                    deployment_count += 1
-
-            print(f" Processed {deployment_count} deployments so far...", end='\r')
-            url = response.links.get('next', {}).get('url')
-        print(f"\n Processed {deployment_count} total deployments")
-
-        print("\n Fetching Issues...")
-        issue_count = 0
-        incident_count = 0
-        url = f"https://api.github.com/repos/{GITHUB_REPO}/issues?state=all&sort=updated&direction=asc&per_page=100"
-        while url:
-            response = github_get(url)
-            response.raise_for_status()
-            issues = response.json()
-
-            for issue in issues:
-                if 'pull_request' in issue:
-                    continue  
-
-                updated_at = datetime.strptime(issue['updated_at'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
-                if last_webhook_at and updated_at <= last_webhook_at:
-                    continue  
-
-                insert_incident(cursor, issue, repo_id)
-                issue_count += 1
-
-                if any(label['name'].lower() in ['incident', 'bug'] for label in issue.get('labels', [])):
-                    incident_count += 1
-
-            print(f"  Processed {issue_count} issues ({incident_count} incidents) so far...", end='\r')
-            url = response.links.get('next', {}).get('url')
-        print(f"\n Processed {issue_count} total issues ({incident_count} incidents)")
-
-        print("\n Linking PRs to deployments...")
-        cursor.execute("""
-            INSERT INTO deployment_prs (deployment_id, pr_id)
-            SELECT d.deployment_id, pr.pr_id
-            FROM deployments d
-            JOIN pull_requests pr ON d.commit_sha = pr.commit_sha
-            WHERE d.repo_id = %s AND pr.repo_id = %s
-            ON CONFLICT DO NOTHING
-        """, (repo_id, repo_id))
-        print(f" Linked {cursor.rowcount} PRs to deployments")
-
-        print("\n Linking incidents to deployments...")
-        cursor.execute("""
-            UPDATE incidents i
-            SET deployment_id = (
-                SELECT d.deployment_id
-                FROM deployments d
-                WHERE d.repo_id = i.repo_id
-                AND d.created_at <= i.created_at
-                ORDER BY d.created_at DESC
-                LIMIT 1
-            )
-            WHERE i.repo_id = %s AND i.deployment_id IS NULL
-        """, (repo_id,))
-
-        cursor.execute("SELECT COUNT(*) FROM incidents WHERE deployment_id IS NOT NULL AND repo_id = %s", (repo_id,))
-        linked_incidents = cursor.fetchone()[0]
-        print(f" Total incidents currently linked to deployments: {linked_incidents}")
-
-
-        current_time = datetime.now(timezone.utc)
-        cursor.execute("UPDATE sync_state SET last_webhook_at = %s WHERE id = 1", (current_time,))
-        print(f"\n Updated last_webhook_at to {current_time}")
-
-        conn.commit()
-    except Exception as e:
-        print(f"\n Error during backfill: {str(e)}")
-        if conn:
+        try:
+            # One-shot historical load, not the live webhook path: the final commit need not wait for
+            # the WAL flush, and the DISTINCT ON sorts over the staged payloads can stay in memory.
+            # SET LOCAL ends with this transaction, so the pooled connection goes back with its defaults.
+            cursor.execute("SET LOCAL synchronous_commit = off")
+            cursor.execute("SET LOCAL work_mem = '64MB'")
+            create_staging_table(cursor, 'pull_requests', PR_COLUMNS)
+            create_staging_table(cursor, 'deployments', DEPLOYMENT_COLUMNS)
+            create_staging_table(cursor, 'incidents', INCIDENT_COLUMNS)
+
+            cursor.execute("SELECT last_webhook_at FROM sync_state WHERE id = 1")
+            row = cursor.fetchone()
+            last_webhook_at = row[0] if row and row[0] else None
+            print(f" Last webhook received at: {last_webhook_at}")
+
+            print(f" Fetching repository details for {GITHUB_REPO}...")
+            repo_data = github_get(f"https://api.github.com/repos/{GITHUB_REPO}").json()
+            if 'id' not in repo_data:
+                raise ValueError(f"Could not fetch repo data: {repo_data.get('message', 'Unknown error')}")
+
+            repo_id = repo_data['id']
+            print(f" Repository ID: {repo_id}")
+
+            print("\n Fetching Pull Requests...")
+            pr_count = 0
+            url = f"https://api.github.com/repos/{GITHUB_REPO}/pulls?state=closed&sort=updated&direction=asc&per_page=100"
+            while url:
+                response = github_get(url)
+                response.raise_for_status()
+                prs = response.json()
+
+                merged_prs = []
+                for pr in prs:
+                    updated_at = parse_github_timestamp(pr['updated_at'])
+                    if last_webhook_at and updated_at <= last_webhook_at:
+                        continue  
+
+                    if pr.get('merged_at'):  
+                        merged_prs.append(pr)
+
+                numbers = [pr['number'] for pr in merged_prs]
+                batches = [numbers[i:i + GRAPHQL_PR_BATCH] for i in range(0, len(numbers), GRAPHQL_PR_BATCH)]
+                first_commits = {}
+                for batch in executor.map(fetch_first_commit_dates, batches):
+                    first_commits.update(batch)
+
+                pr_rows = [pull_request_row(pr, repo_id, first_commits.get(pr['number'])) for pr in merged_prs]
+                pr_count += len(pr_rows)
+                stage_rows(cursor, 'pull_requests', PR_COLUMNS, pr_rows)
+
+                print(f" Processed {pr_count} PRs so far...", end='\r')
+                url = response.links.get('next', {}).get('url')
+            merge_pull_requests(cursor)
+            print(f"\n Processed {pr_count} total PRs")
+
+            print("\n Fetching Deployments...")
+            deployment_count = 0
+            url = f"https://api.github.com/repos/{GITHUB_REPO}/deployments?per_page=100"
+            while url:
+                response = github_get(url)
+                response.raise_for_status()
+                deployments = response.json()
+
+                statuses_by_deployment = executor.map(
+                    lambda d: github_get(d['statuses_url']).json(), deployments
+                )
+
+                deployment_rows = []
+                for deployment, statuses in zip(deployments, statuses_by_deployment):
+                    success_status = next((s for s in statuses if s['state'] == 'success'), None)
+
+                    if success_status:
+                        created_at = parse_github_timestamp(success_status['created_at'])
+                        if last_webhook_at and created_at <= last_webhook_at:
+                            continue  # Skip old deployments
+
+                        deployment_rows.append(deployment_row(deployment, success_status, repo_id))
+                        deployment_count += 1
+
+                stage_rows(cursor, 'deployments', DEPLOYMENT_COLUMNS, deployment_rows)
+
+                print(f" Processed {deployment_count} deployments so far...", end='\r')
+                url = response.links.get('next', {}).get('url')
+            merge_deployments(cursor)
+            print(f"\n Processed {deployment_count} total deployments")
+
+            print("\n Fetching Issues...")
+            issue_count = 0
+            incident_count = 0
+            url = f"https://api.github.com/repos/{GITHUB_REPO}/issues?state=all&sort=updated&direction=asc&per_page=100"
+            while url:
+                response = github_get(url)
+                response.raise_for_status()
+                issues = response.json()
+
+                incident_rows = []
+                for issue in issues:
+                    if 'pull_request' in issue:
+                        continue  
+
+                    updated_at = parse_github_timestamp(issue['updated_at'])
+                    if last_webhook_at and updated_at <= last_webhook_at:
+                        continue  
+
+                    incident_rows.append(incident_row(issue, repo_id))
+                    issue_count += 1
+
+                    if any(label['name'].lower() in ['incident', 'bug'] for label in issue.get('labels', [])):
+                        incident_count += 1
+
+                stage_rows(cursor, 'incidents', INCIDENT_COLUMNS, incident_rows)
+
+                print(f"  Processed {issue_count} issues ({incident_count} incidents) so far...", end='\r')
+                url = response.links.get('next', {}).get('url')
+            merge_incidents(cursor)
+            print(f"\n Processed {issue_count} total issues ({incident_count} incidents)")
+
+            print("\n Linking PRs to deployments...")
+            cursor.execute("SELECT MIN(created_at), MAX(created_at) FROM deployments WHERE repo_id = %s", (repo_id,))
+            first_deployment_at, last_deployment_at = cursor.fetchone()
+            linked_prs = 0
+            # One month of deployments per statement keeps the join's working set bounded on large repos
+            for window_start, window_end in month_windows(first_deployment_at, last_deployment_at):
+                cursor.execute("""
+                    INSERT INTO deployment_prs (deployment_id, pr_id)
+                    SELECT d.deployment_id, pr.pr_id
+                    FROM deployments d
+                    JOIN pull_requests pr ON d.commit_sha = pr.commit_sha
+                    WHERE d.repo_id = %s AND pr.repo_id = %s
+                    AND d.created_at >= %s AND d.created_at < %s
+                    ON CONFLICT DO NOTHING
+                """, (repo_id, repo_id, window_start, window_end))
+                linked_prs += cursor.rowcount
+            print(f" Linked {linked_prs} PRs to deployments")
+
+            print("\n Linking incidents to deployments...")
+            cursor.execute("""
+                UPDATE incidents i
+                SET deployment_id = latest.deployment_id
+                FROM (
+                    SELECT i2.issue_id, d.deployment_id
+                    FROM incidents i2
+                    CROSS JOIN LATERAL (
+                        SELECT d.deployment_id
+                        FROM deployments d
+                        WHERE d.repo_id = i2.repo_id
+                        AND d.created_at <= i2.created_at
+                        ORDER BY d.created_at DESC
+                        LIMIT 1
+                    ) d
+                    WHERE i2.repo_id = %s AND i2.deployment_id IS NULL
+                ) latest
+                WHERE i.issue_id = latest.issue_id
+            """, (repo_id,))
+
+            cursor.execute("SELECT COUNT(*) FROM incidents WHERE deployment_id IS NOT NULL AND repo_id = %s", (repo_id,))
+            linked_incidents = cursor.fetchone()[0]
+            print(f" Total incidents currently linked to deployments: {linked_incidents}")
+
+
+            current_time = datetime.now(timezone.utc)
+            cursor.execute("UPDATE sync_state SET last_webhook_at = %s WHERE id = 1", (current_time,))
+            print(f"\n Updated last_webhook_at to {current_time}")
+
+            conn.commit()
+        except Exception as e:
+            print(f"\n Error during backfill: {str(e)}")
             conn.rollback()
-        raise
-    finally:
-        if conn:
+            raise
+        finally:
             cursor.close()
-            conn.close()
-        print("\n Backfill completed successfully!")
+            print("\n Backfill completed successfully!")
 
 if __name__ == "__main__":
     backfill()
\ No newline at end of file
@@ -0,0 +1,31 @@
+# grafana_client.py
+import threading
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+def get_grafana_session():
+    """Shared keep-alive session for Grafana API calls, built (and requests imported) on first use"""
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=10,
+                pool_maxsize=20,
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=0.5,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    allowed_methods=['GET', 'HEAD']
+                )
+            )
+            # Grafana may be served over plain http locally, so both schemes share the pooled adapter
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _SESSION = session
+    return _SESSION
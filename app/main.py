@@ -1,11 +1,18 @@
 import os
-import requests
-from flask import Flask
-from webhook_server import app as webhook_app
-from db_utils import initialize_db , get_db_connection
-from github_auth import get_installation_token
-from metrics_processor import process_metrics
-from github_backfill import backfill
+import sys
+import time
+import threading
+import subprocess
+from grafana_client import get_grafana_session
+
+# Third-party and project modules (requests, APScheduler, psycopg2, Flask via webhook_server) are imported
+# inside the functions that use them, so importing this module or running one step stays cheap.
+
+# Last ETag seen per dashboard URL; lets Grafana answer repeat checks with a bodiless 304
+_grafana_etags = {}
+
+# (connect, read) seconds; a hung Grafana must not stall the scheduled metrics job
+GRAFANA_TIMEOUT = (3.05, 10)
 
 def refresh_grafana_dashboard():
     dashboard_uid = os.getenv('GRAFANA_DASHBOARD_UID', 'dora-metrics')
@@ -22,36 +29,81 @@ def refresh_grafana_dashboard():
         "Content-Type": "application/json"
     }
 
+    if url in _grafana_etags:
+        headers["If-None-Match"] = _grafana_etags[url]
+
     try:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
+        # Liveness only needs the status line, so skip the dashboard JSON body
+        session = get_grafana_session()
+        response = session.head(url, headers=headers, timeout=GRAFANA_TIMEOUT)
+        if response.status_code == 405:
+            response = session.get(url, headers=headers, timeout=GRAFANA_TIMEOUT)
+        if response.status_code in (200, 304):
+            if response.headers.get('ETag'):
+                _grafana_etags[url] = response.headers['ETag']
             print(f"Grafana dashboard '{dashboard_uid}' is reachable.")
         else:
             print(f"Grafana dashboard check failed: {response.status_code} - {response.text}")
     except Exception as e:
         print(f"Error checking Grafana dashboard: {e}")
 
+# Skip the ping when the dashboard was checked this recently
+GRAFANA_PING_INTERVAL_SECONDS = 300
+_last_grafana_ping = 0.0
+_grafana_ping_lock = threading.Lock()
+
+def ping_grafana_in_background():
+    """Check the dashboard off the metrics job's thread, at most once per GRAFANA_PING_INTERVAL_SECONDS"""
+    global _last_grafana_ping
+    with _grafana_ping_lock:
+        now = time.monotonic()
+        if _last_grafana_ping and now - _last_grafana_ping < GRAFANA_PING_INTERVAL_SECONDS:
+            return
+        _last_grafana_ping = now
+    threading.Thread(target=refresh_grafana_dashboard, daemon=True).start()
+
 def metrics_job():
+    from db_utils import db_conn
+    from metrics_processor import process_metrics
+
     try:
         print(" Running DORA metrics processing...")
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT last_webhook_at FROM sync_state WHERE id = 1")
-        row = cursor.fetchone()
+        with db_conn() as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT last_webhook_at FROM sync_state WHERE id = 1")
+            row = cursor.fetchone()
         last_webhook_at = row[0].date() if row and row[0] else None
-        cursor.close()
-        conn.close()
 
         results = process_metrics(start_date=last_webhook_at)
 
         print(f" Processed metrics for {len(results)} dates.")
-        refresh_grafana_dashboard()
+        ping_grafana_in_background()
     except Exception as e:
         print(f" Metrics job failed: {str(e)}")
 
 
+def start_scheduler():
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from apscheduler.triggers.cron import CronTrigger
+
+    # Timer-based: the scheduler sleeps until the next fire time instead of polling
+    schedule_cron = os.getenv('SCHEDULE_CRON', '5 0 * * *')
+    scheduler = BackgroundScheduler(daemon=True)
+    scheduler.add_job(
+        metrics_job,
+        CronTrigger.from_crontab(schedule_cron, timezone='UTC'),
+        id='metrics_job',
+        coalesce=True,
+        max_instances=1
+    )
+    scheduler.start()
+    print(f"Scheduled metrics job with cron '{schedule_cron}' (UTC).")
+    return scheduler
+
 def setup_application():
+    from db_utils import initialize_db
+    from github_backfill import backfill
+
     print("Starting application setup...")
     print("Running DB initialization and GitHub backfill...")
     initialize_db()
@@ -60,14 +112,28 @@ def setup_application():
     print("Running initial metrics calculation...")
     metrics_job()
 
-    return webhook_app
+def serve_webhooks():
+    """Run the webhook app under gunicorn in a child process; this process keeps the scheduler"""
+    # exec'd child, not a fork: workers never inherit this process's pooled DB sockets or scheduler thread
+    command = [
+        sys.executable, '-m', 'gunicorn',
+        '-w', os.getenv('GUNICORN_WORKERS', '4'),
+        '-k', 'gthread',
+        '--threads', os.getenv('GUNICORN_THREADS', '8'),
+        '-b', '0.0.0.0:5000',
+        'webhook_server:app'
+    ]
+    return subprocess.run(command, cwd=os.path.dirname(os.path.abspath(__file__))).returncode
 
 if __name__ == '__main__':
-    app = setup_application()
+    setup_application()
+    scheduler = start_scheduler()
     try:
         print("Starting DORA Metrics Webhook Server on port 5000...")
-        app.run(host='0.0.0.0', port=5000, use_reloader=False)
+        serve_webhooks()
     except KeyboardInterrupt:
         print("Shutdown requested by user (CTRL+C)")
     except Exception as e:
         print(f"Fatal error: {e}")
+    finally:
+        scheduler.shutdown(wait=False)
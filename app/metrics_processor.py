@@ -1,16 +1,8 @@
-import os
 import logging
-import json
 from datetime import datetime, timedelta
-from db_utils import get_db_connection
-from github_auth import get_installation_token
-from dora_calculations import detect_production_deployment
-from dora_calculations import (
-    calculate_lead_time,
-    calculate_failure_rate,
-    calculate_mttr
-)
-import psycopg2
+from psycopg2.extras import execute_values
+from db_utils import db_conn, create_staging_table, stage_rows
+from dora_calculations import calculate_failure_rate
 
 logger = logging.getLogger(__name__)
 
@@ -19,168 +11,227 @@ def daterange(start_date, end_date):
     for n in range((end_date - start_date).days + 1):
         yield start_date + timedelta(days=n)
 
-def process_repo_metrics(cursor, repo_id, start_time, end_time, metric_date):
-    cursor.execute("""
-        SELECT 
-            d.deployment_id, d.commit_sha, d.created_at,
-            d.environment, d.payload
-        FROM deployments d
-        WHERE 
-            d.repo_id = %s AND
-            d.created_at BETWEEN %s AND %s AND
-            d.status = 'success'
-    """, (repo_id, start_time, end_time))
-    all_deployments = cursor.fetchall()
-
-    prod_deployments = [
-        (dep_id, commit_sha, created_at)
-        for dep_id, commit_sha, created_at, environment, payload in all_deployments
-        if detect_production_deployment(environment, payload)
-    ]
-
-    deployment_count = len(prod_deployments)
-
-    lead_times = []
-    for dep_id, commit_sha, deploy_time in prod_deployments:
-        cursor.execute("""
-            SELECT pr.first_commit_at
-            FROM deployment_prs dp
-            JOIN pull_requests pr ON dp.pr_id = pr.pr_id
-            WHERE dp.deployment_id = %s
-        """, (dep_id,))
-        for (first_commit,) in cursor.fetchall():
-            lead_time = calculate_lead_time(first_commit, None, deploy_time)
-            lead_times.append(lead_time)
-
-    prod_deployment_ids = tuple([d[0] for d in prod_deployments]) or (0,)
-    cursor.execute(f"""
-        SELECT d.created_at
-        FROM deployments d
-        LEFT JOIN deployment_prs dp ON d.deployment_id = dp.deployment_id
-        WHERE 
-            d.repo_id = %s AND
-            d.created_at BETWEEN %s AND %s AND
-            d.status = 'success' AND
-            dp.pr_id IS NULL AND
-            d.deployment_id IN %s
-    """, (repo_id, start_time, end_time, prod_deployment_ids))
-    for (deploy_time,) in cursor.fetchall():
-        lead_times.append(calculate_lead_time(deploy_time, None, deploy_time))
-
-    mean_lead_time = sum(lead_times) / len(lead_times) if lead_times else 0.0
-
-    cursor.execute("""
-        SELECT COUNT(DISTINCT i.deployment_id)
-        FROM incidents i
-        WHERE i.repo_id = %s
-              AND i.deployment_id IN (
-                  SELECT d.deployment_id
-                  FROM deployments d
-                  WHERE d.repo_id = %s
-                    AND d.created_at BETWEEN %s AND %s
-              ) 
-    """, (repo_id, repo_id, start_time, end_time))
-    failed_deployments = cursor.fetchone()[0] or 0
-    failure_rate = calculate_failure_rate(deployment_count, failed_deployments)
-
-    cursor.execute("""
-        SELECT created_at, closed_at
-        FROM incidents
-        WHERE repo_id = %s
-          AND closed_at IS NOT NULL
-          AND DATE(closed_at) = %s
-    """, (repo_id, metric_date))
-    rows = cursor.fetchall()
-
-    mttr_times = [calculate_mttr(created_at, closed_at) for created_at, closed_at in rows]
-    mean_mttr = sum(mttr_times) / len(mttr_times) if mttr_times else 0.0
-
-    mean_lead_time = round(mean_lead_time, 3)
-    failure_rate = round(failure_rate, 3)
-    mean_mttr = round(mean_mttr, 3)
-
-    cursor.execute("""
+def upsert_metrics(cursor, rows):
+    execute_values(cursor, """
         INSERT INTO dora_metrics (
             repo_id, metric_date, 
             deployment_frequency, lead_time_hours,
             change_failure_rate, mttr_hours
         )
-        VALUES (%s, %s, %s, %s, %s, %s)
+        VALUES %s
         ON CONFLICT (repo_id, metric_date) DO UPDATE SET
             deployment_frequency = EXCLUDED.deployment_frequency,
             lead_time_hours = EXCLUDED.lead_time_hours,
             change_failure_rate = EXCLUDED.change_failure_rate,
             mttr_hours = EXCLUDED.mttr_hours,
             last_updated = NOW()
-    """, (
-        repo_id,
-        metric_date,
-        deployment_count,
-        mean_lead_time,
-        failure_rate,
-        mean_mttr
-    ))
-
-    return {
-        'deployments': deployment_count,
-        'lead_time': mean_lead_time,
-        'failure_rate': failure_rate,
-        'mttr': mean_mttr
-    }
-
-def process_metrics(start_date=None):
-    logger.info("Starting historical daily metrics processing...")
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("""
-            SELECT MIN(min_date) FROM (
-                SELECT MIN(created_at) AS min_date FROM deployments
-                UNION
-                SELECT MIN(created_at) AS min_date FROM pull_requests
-                UNION
-                SELECT MIN(created_at) AS min_date FROM incidents
-            ) AS dates
-        """)
-        first_date_row = cursor.fetchone()
-        default_start = first_date_row[0].date() if first_date_row and first_date_row[0] else datetime.utcnow().date()
-
-        if not start_date:
-            start_date = default_start
-        else:
-            start_date = max(start_date, default_start)
-
-        today = datetime.utcnow().date()
-
-        cursor.execute("""
-            SELECT DISTINCT repo_id FROM (
-                SELECT repo_id FROM deployments
-                UNION SELECT repo_id FROM pull_requests
-                UNION SELECT repo_id FROM incidents
-            ) AS active_repos
-        """)
-        repos = [row[0] for row in cursor.fetchall()]
-
-        results = {}
-        for single_date in daterange(start_date, today):  # ✅ corrected this line
-            start_time = datetime.combine(single_date, datetime.min.time())
-            end_time = start_time + timedelta(days=1)
-            metric_date = single_date
+    """, rows, page_size=500)
 
-            for repo_id in repos:
-                logger.info(f"Processing metrics for repo: {repo_id} on {metric_date}")
-                results[(repo_id, metric_date)] = process_repo_metrics(
-                    cursor, repo_id, start_time, end_time, metric_date
+METRIC_COLUMNS = (
+    'repo_id', 'metric_date',
+    'deployment_frequency', 'lead_time_hours',
+    'change_failure_rate', 'mttr_hours'
+)
+
+def copy_upsert_metrics(cursor, rows):
+    """Bulk variant of upsert_metrics: COPY rows into a temp staging table, then merge in one statement
+
+    Rows carry a trailing source_updated_at, the staleness watermark find_stale_repos compares against.
+    """
+    staged_columns = METRIC_COLUMNS + ('source_updated_at',)
+    columns = ', '.join(staged_columns)
+    create_staging_table(cursor, 'dora_metrics', staged_columns)
+    stage_rows(cursor, 'dora_metrics', staged_columns, rows)
+    cursor.execute(f"""
+        INSERT INTO dora_metrics ({columns})
+        SELECT {columns} FROM dora_metrics_stage
+        ON CONFLICT (repo_id, metric_date) DO UPDATE SET
+            deployment_frequency = EXCLUDED.deployment_frequency,
+            lead_time_hours = EXCLUDED.lead_time_hours,
+            change_failure_rate = EXCLUDED.change_failure_rate,
+            mttr_hours = EXCLUDED.mttr_hours,
+            source_updated_at = EXCLUDED.source_updated_at,
+            last_updated = NOW()
+    """)
+
+def load_daily_aggregates(cursor, start_time, end_time, repo_ids=None):
+    """Return {(repo_id, day): (deployments, failed deployments, mean lead time h, mean MTTR h)} for [start_time, end_time)
+
+    Every metric for every repo (or just those in repo_ids) comes back from a single query;
+    repo/days with no activity are absent. Bounds are midnight-aligned UTC days: deployments are bucketed by their
+    UTC created_date and incidents by the UTC date they closed, whatever the session time zone.
+    """
+    # Server-side cursor: with many repos x days the grouped rows stream in itersize chunks
+    with cursor.connection.cursor(name='daily_aggregates') as agg_cursor:
+        agg_cursor.itersize = 5000
+        agg_cursor.execute("""
+            WITH deploys AS (
+                SELECT
+                    d.repo_id,
+                    d.deployment_id,
+                    d.created_at,
+                    d.created_date,
+                    d.status = 'success' AND d.is_prod AS is_prod_success
+                FROM deployments d
+                WHERE
+                    (%(repo_ids)s::bigint[] IS NULL OR d.repo_id = ANY(%(repo_ids)s::bigint[])) AND
+                    d.created_date >= %(start_time)s::date AND d.created_date < %(end_time)s::date
+            ), lead AS (
+                -- Deployments without a linked PR count with the minimum lead time
+                SELECT
+                    dd.repo_id,
+                    dd.created_date AS day,
+                    COUNT(DISTINCT dd.deployment_id) AS deployments,
+                    AVG(GREATEST(
+                        EXTRACT(EPOCH FROM (dd.created_at - COALESCE(pr.first_commit_at, dd.created_at))) / 3600.0,
+                        0.1
+                    )) AS lead_time
+                FROM deploys dd
+                LEFT JOIN deployment_prs dp ON dp.deployment_id = dd.deployment_id
+                LEFT JOIN pull_requests pr ON pr.pr_id = dp.pr_id
+                WHERE dd.is_prod_success
+                GROUP BY dd.repo_id, day
+            ), failures AS (
+                SELECT dd.repo_id, dd.created_date AS day, COUNT(*) AS failed
+                FROM deploys dd
+                WHERE EXISTS (
+                    SELECT 1 FROM incidents i
+                    WHERE i.deployment_id = dd.deployment_id AND i.repo_id = dd.repo_id AND i.is_incident = TRUE
                 )
+                GROUP BY dd.repo_id, day
+            ), mttr AS (
+                SELECT
+                    repo_id,
+                    (closed_at AT TIME ZONE 'UTC')::date AS day,
+                    AVG(GREATEST(EXTRACT(EPOCH FROM (closed_at - created_at)) / 3600.0, 0)) AS mttr
+                FROM incidents
+                WHERE
+                    is_incident = TRUE AND
+                    (%(repo_ids)s::bigint[] IS NULL OR repo_id = ANY(%(repo_ids)s::bigint[])) AND
+                    closed_at >= (%(start_time)s::date::timestamp AT TIME ZONE 'UTC') AND
+                    closed_at < (%(end_time)s::date::timestamp AT TIME ZONE 'UTC')
+                GROUP BY repo_id, day
+            )
+            SELECT
+                repo_id,
+                day,
+                COALESCE(lead.deployments, 0),
+                COALESCE(failures.failed, 0),
+                COALESCE(lead.lead_time, 0),
+                COALESCE(mttr.mttr, 0)
+            FROM lead
+            FULL JOIN failures USING (repo_id, day)
+            FULL JOIN mttr USING (repo_id, day)
+        """, {'repo_ids': repo_ids, 'start_time': start_time, 'end_time': end_time})
+        return {
+            (row_repo_id, day): (deployments, failed, float(lead_time), float(mttr))
+            for row_repo_id, day, deployments, failed, lead_time, mttr in agg_cursor
+        }
+
+def build_daily_metrics(repo_id, start_date, end_date, aggregates):
+    """Zero-fill every day in [start_date, end_date]; returns (dora_metrics rows, {date: metrics})"""
+    results = {}
+    rows = []
+    for metric_date in daterange(start_date, end_date):
+        deployment_count, failed_deployments, mean_lead_time, mean_mttr = aggregates.get(
+            (repo_id, metric_date), (0, 0, 0.0, 0.0)
+        )
+        failure_rate = calculate_failure_rate(deployment_count, failed_deployments)
+
+        mean_lead_time = round(mean_lead_time, 3)
+        failure_rate = round(failure_rate, 3)
+        mean_mttr = round(mean_mttr, 3)
 
-        conn.commit()
-        logger.info("Historical metrics processing completed successfully")
-        return results
+        rows.append((repo_id, metric_date, deployment_count, mean_lead_time, failure_rate, mean_mttr))
+        results[metric_date] = {
+            'deployments': deployment_count,
+            'lead_time': mean_lead_time,
+            'failure_rate': failure_rate,
+            'mttr': mean_mttr
+        }
+    return rows, results
 
+def process_repo_metrics(cursor, repo_id, start_time, end_time, metric_date):
+    aggregates = load_daily_aggregates(cursor, start_time, end_time, [repo_id])
+    rows, results = build_daily_metrics(repo_id, metric_date, metric_date, aggregates)
+    upsert_metrics(cursor, rows)
+    return results[metric_date]
+
+def find_stale_repos(cursor, last_activity, start_date, end_date):
+    """Return the repos whose stored metrics for [start_date, end_date] are missing days or predate their last write
+
+    Metrics are compared by source_updated_at, the MAX(updated_at) seen when they were computed, not by
+    last_updated: a write committed after that snapshot but stamped with an earlier NOW() would otherwise
+    look older than the metrics and never be picked up.
+    """
+    cursor.execute("""
+        SELECT repo_id, COUNT(*), COUNT(source_updated_at), MIN(source_updated_at)
+        FROM dora_metrics
+        WHERE metric_date BETWEEN %s AND %s
+        GROUP BY repo_id
+    """, (start_date, end_date))
+    computed = {repo_id: (days, watermarked, watermark) for repo_id, days, watermarked, watermark in cursor}
+
+    expected_days = (end_date - start_date).days + 1
+    stale = []
+    for repo_id, activity_at in last_activity.items():
+        days, watermarked, watermark = computed.get(repo_id, (0, 0, None))
+        # Rows written by the per-day webhook path have no watermark yet
+        if days < expected_days or watermarked < days or watermark < activity_at:
+            stale.append(repo_id)
+    return stale
+
+def process_metrics(start_date=None, raise_errors=False, force=False):
+    logger.info("Starting historical daily metrics processing...")
+    try:
+        with db_conn() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                WITH src AS (
+                    SELECT repo_id, created_at, updated_at FROM deployments
+                    UNION ALL SELECT repo_id, created_at, updated_at FROM pull_requests
+                    UNION ALL SELECT repo_id, created_at, updated_at FROM incidents
+                )
+                SELECT repo_id, MIN(created_at), MAX(updated_at) FROM src GROUP BY repo_id
+            """)
+            activity = cursor.fetchall()
+            first_created_at = min((created_at for _, created_at, _ in activity), default=None)
+            last_activity = {repo_id: updated_at for repo_id, _, updated_at in activity}
+            default_start = first_created_at.date() if first_created_at else datetime.utcnow().date()
+
+            if not start_date:
+                start_date = default_start
+            else:
+                start_date = max(start_date, default_start)
+
+            today = datetime.utcnow().date()
+            start_time = datetime.combine(start_date, datetime.min.time())
+            end_time = datetime.combine(today + timedelta(days=1), datetime.min.time())
+
+            # Repos with no writes since their metrics were last computed would be rewritten unchanged;
+            # force recomputes every repo regardless (manual /calculate)
+            repos = list(last_activity) if force else find_stale_repos(cursor, last_activity, start_date, today)
+            logger.info(f"Processing metrics for {len(repos)} of {len(last_activity)} repos from {start_date} to {today}")
+            if not repos:
+                return {}
+
+            # One grouped pass covers every stale repo; their rows are loaded with COPY and merged at once
+            aggregates = load_daily_aggregates(cursor, start_time, end_time, repos)
+
+            results = {}
+            rows = []
+            for repo_id in repos:
+                repo_rows, repo_results = build_daily_metrics(repo_id, start_date, today, aggregates)
+                # Watermark is the repo's MAX(updated_at) read above, before the aggregates were taken
+                rows.extend(row + (last_activity[repo_id],) for row in repo_rows)
+                for metric_date, metrics in repo_results.items():
+                    results[(repo_id, metric_date)] = metrics
+
+            copy_upsert_metrics(cursor, rows)
+            conn.commit()
+            logger.info("Historical metrics processing completed successfully")
+            return results
     except Exception as e:
         logger.error(f"Error processing historical metrics: {e}")
+        if raise_errors:
+            raise
         return {}
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
@@ -1,173 +1,313 @@
-import os
-import json
 import logging
-import hmac
-import hashlib
-import requests
-from flask import Flask, request, jsonify
-from datetime import datetime, timedelta
-from db_utils import get_db_connection, initialize_db
-from dora_calculations import detect_production_deployment, median
+import time
+import decimal
+import threading
+import orjson
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, jsonify, g
+from flask.json.provider import JSONProvider
+from flask_compress import Compress
+from datetime import datetime, timedelta, timezone
+from db_utils import get_db_connection, release_db_connection, initialize_db, db_conn, execute_prepared
+from dora_calculations import detect_production_deployment, parse_github_timestamp
 from metrics_processor import process_metrics, process_repo_metrics
-from github_auth import get_installation_token  
+from github_backfill import github_get
+from github_auth import verify_webhook_signature
+
+# orjson writes datetimes as RFC 3339 itself; stored timestamps are UTC, so naive ones are tagged as such
+ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC
+
+def _orjson_default(obj):
+    # Same fallback Flask's default provider uses for NUMERIC columns
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+class OrjsonProvider(JSONProvider):
+    """Serve jsonify() responses through orjson instead of the stdlib json module"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_orjson_default, option=ORJSON_OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=_orjson_default, option=ORJSON_OPTIONS),
+            mimetype='application/json'
+        )
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# JSON from the read endpoints shrinks several-fold; tiny bodies like /health are not worth compressing
+app.config['COMPRESS_MIMETYPES'] = ['application/json']
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 512
+Compress(app)
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-# Verify GitHub webhook signature
-def verify_signature(payload_body, signature_header):
-    secret = os.getenv('GITHUB_WEBHOOK_SECRET').encode()
-    hash_object = hmac.new(secret, msg=payload_body, digestmod=hashlib.sha256)
-    expected_signature = 'sha256=' + hash_object.hexdigest()
-    return hmac.compare_digest(expected_signature, signature_header)
-
-# Link PR to deployment by commit SHA
-def link_pr_to_deployment(cursor, repo_id, pr_id, commit_sha):
+def get_request_cursor():
+    """Cursor on a pooled connection held for the rest of the request; teardown_request hands it back"""
+    if 'db_conn' not in g:
+        g.db_conn = get_db_connection()
+        g.db_cursor = g.db_conn.cursor()
+    return g.db_cursor
+
+@app.teardown_request
+def release_request_connection(exc):
+    conn = g.pop('db_conn', None)
+    if conn is None:
+        return
+    g.pop('db_cursor').close()
+    # putconn rolls back whatever a failed request left open
+    release_db_connection(conn)
+
+# Dashboards poll the read endpoints; identical requests inside this window are answered from memory
+RESPONSE_CACHE_TTL_SECONDS = 10
+RESPONSE_CACHE_MAX_ENTRIES = 256
+_response_cache = {}
+_response_cache_lock = threading.Lock()
+
+def cached_response(view):
+    """Serve a GET view's successful JSON response from a per-process cache for RESPONSE_CACHE_TTL_SECONDS"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.full_path
+        with _response_cache_lock:
+            cached = _response_cache.get(key)
+        if cached and time.monotonic() - cached[0] < RESPONSE_CACHE_TTL_SECONDS:
+            return app.response_class(cached[1], status=200, mimetype='application/json')
+
+        response, status = view(*args, **kwargs)
+        if status == 200:
+            _store_response(key, response.get_data())
+        return response, status
+    return wrapper
+
+def _store_response(key, body):
+    with _response_cache_lock:
+        _response_cache.pop(key, None)
+        if len(_response_cache) >= RESPONSE_CACHE_MAX_ENTRIES:
+            _response_cache.pop(next(iter(_response_cache)))
+        _response_cache[key] = (time.monotonic(), body)
+
+def clear_response_cache():
+    with _response_cache_lock:
+        _response_cache.clear()
+
+# first_commit_at per (pr_id, commit_sha): edits and redeliveries of a merged PR reuse it,
+# and once stale the stored ETag lets GitHub answer 304 without spending rate limit
+COMMITS_CACHE_TTL_SECONDS = 3600
+COMMITS_CACHE_MAX_ENTRIES = 4096
+_commits_cache = {}
+_commits_cache_lock = threading.Lock()
+
+def fetch_first_commit_at(pr_id, commit_sha, commits_url):
+    """Return the earliest commit author date of a PR, or None if it has no commits"""
+    key = (pr_id, commit_sha)
+    with _commits_cache_lock:
+        cached = _commits_cache.get(key)
+    if cached and time.monotonic() - cached[0] < COMMITS_CACHE_TTL_SECONDS:
+        return cached[2]
+
+    extra_headers = {"If-None-Match": cached[1]} if cached and cached[1] else None
+    response = github_get(commits_url, extra_headers=extra_headers)
+    if response.status_code == 304 and cached:
+        etag, first_commit_at = cached[1], cached[2]
+    else:
+        response.raise_for_status()
+        commits = response.json()
+        etag = response.headers.get('ETag')
+        first_commit_at = min(
+            parse_github_timestamp(c['commit']['author']['date'])
+            for c in commits
+        ) if commits and isinstance(commits, list) else None
+
+    with _commits_cache_lock:
+        _commits_cache.pop(key, None)
+        if len(_commits_cache) >= COMMITS_CACHE_MAX_ENTRIES:
+            _commits_cache.pop(next(iter(_commits_cache)))
+        _commits_cache[key] = (time.monotonic(), etag, first_commit_at)
+    return first_commit_at
+
+# Commit lookups run here so GitHub latency never holds up the webhook response
+_first_commit_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='first-commit')
+
+def update_first_commit_at(repo_id, pr_id, commit_sha, commits_url):
+    """Background job: store the PR's real first_commit_at and refresh today's metrics for its repo"""
     try:
-        cursor.execute("""
-            INSERT INTO deployment_prs (deployment_id, pr_id)
-            SELECT deployment_id, %s
-            FROM deployments
-            WHERE repo_id = %s AND commit_sha = %s
-            ON CONFLICT DO NOTHING
-        """, (pr_id, repo_id, commit_sha))
+        first_commit_at = fetch_first_commit_at(pr_id, commit_sha, commits_url)
+        if first_commit_at is None:
+            return
+        with db_conn() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE pull_requests SET first_commit_at = %s
+                WHERE pr_id = %s AND first_commit_at IS DISTINCT FROM %s
+            """, (first_commit_at, pr_id, first_commit_at))
+            if cursor.rowcount:
+                metric_date = datetime.utcnow().date()
+                start_time = datetime.combine(metric_date, datetime.min.time())
+                process_repo_metrics(cursor, repo_id, start_time, start_time + timedelta(days=1), metric_date)
+            conn.commit()
     except Exception as e:
-        logger.error(f"Error linking PR to deployment: {str(e)}")
+        logger.warning(f"Could not update first commit for PR {pr_id}: {e}")
+
+# Webhook writes are the same few statements every time; each pooled connection prepares them once
+INSERT_DEPLOYMENT_SQL = """
+    INSERT INTO deployments (
+        repo_id, deployment_id, environment, status,
+        created_at, commit_sha, payload
+    )
+    VALUES ($1, $2, $3, $4, $5, $6, $7)
+    ON CONFLICT (deployment_id) DO UPDATE SET
+        status = EXCLUDED.status,
+        payload = EXCLUDED.payload
+"""
+
+# Upserts the PR and links it to the deployments of its merge commit in one statement
+INSERT_PULL_REQUEST_SQL = """
+    WITH pr AS (
+        INSERT INTO pull_requests (
+            repo_id, pr_id, merged_at, created_at,
+            first_commit_at, base_branch, commit_sha, pr_name, payload
+        )
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+        ON CONFLICT (pr_id) DO UPDATE SET
+            merged_at = EXCLUDED.merged_at,
+            commit_sha = EXCLUDED.commit_sha,
+            pr_name = EXCLUDED.pr_name,
+            first_commit_at = LEAST(pull_requests.first_commit_at, EXCLUDED.first_commit_at),
+            payload = EXCLUDED.payload
+        RETURNING repo_id, pr_id, commit_sha
+    )
+    INSERT INTO deployment_prs (deployment_id, pr_id)
+    SELECT d.deployment_id, pr.pr_id
+    FROM pr
+    JOIN deployments d ON d.repo_id = pr.repo_id AND d.commit_sha = pr.commit_sha
+    WHERE pr.commit_sha <> ''
+    ON CONFLICT DO NOTHING
+"""
+
+INSERT_INCIDENT_SQL = """
+    INSERT INTO incidents (
+        repo_id, issue_id, created_at, closed_at,
+        is_incident, payload
+    )
+    VALUES ($1, $2, $3, $4, $5, $6)
+    ON CONFLICT (issue_id) DO UPDATE SET
+        closed_at = EXCLUDED.closed_at,
+        is_incident = EXCLUDED.is_incident,
+        payload = EXCLUDED.payload
+"""
+
+# Nearest deployment within 24h: the closest one on each side is a single probe of idx_deployments_repo_created
+LINK_INCIDENT_SQL = """
+    UPDATE incidents
+    SET deployment_id = (
+        SELECT deployment_id
+        FROM (
+            (
+                SELECT deployment_id, created_at
+                FROM deployments
+                WHERE repo_id = $1 AND
+                      created_at <= $2::timestamptz AND created_at >= $2::timestamptz - INTERVAL '24 HOURS'
+                ORDER BY created_at DESC
+                LIMIT 1
+            )
+            UNION ALL
+            (
+                SELECT deployment_id, created_at
+                FROM deployments
+                WHERE repo_id = $1 AND
+                      created_at > $2::timestamptz AND created_at <= $2::timestamptz + INTERVAL '24 HOURS'
+                ORDER BY created_at
+                LIMIT 1
+            )
+        ) AS nearest
+        ORDER BY GREATEST(created_at, $2::timestamptz) - LEAST(created_at, $2::timestamptz)
+        LIMIT 1
+    )
+    WHERE issue_id = $3
+"""
 
 # Handle deployment webhook
-def handle_deployment_event(cursor, payload):
+def handle_deployment_event(cursor, payload, payload_json):
     deployment = payload['deployment']
     status = payload['deployment_status']['state']
     repo_id = payload['repository']['id']
     commit_sha = deployment.get('sha', '')
 
     try:
-        created_at = datetime.strptime(payload['deployment_status']['created_at'], '%Y-%m-%dT%H:%M:%SZ')
+        created_at = parse_github_timestamp(payload['deployment_status']['created_at'])
     except:
-        created_at = datetime.utcnow()
+        created_at = datetime.now(timezone.utc)
 
-    if status == 'success' and detect_production_deployment(payload):
+    if status == 'success' and detect_production_deployment(deployment.get('environment', ''), payload):
         try:
-            cursor.execute("""
-                INSERT INTO deployments (
-                    repo_id, deployment_id, environment, status,
-                    created_at, commit_sha, payload
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (deployment_id) DO UPDATE SET
-                    status = EXCLUDED.status,
-                    payload = EXCLUDED.payload
-            """, (
+            execute_prepared(cursor, 'insert_deployment', INSERT_DEPLOYMENT_SQL, (
                 repo_id,
                 deployment['id'],
                 deployment.get('environment', ''),
                 status,
                 created_at,
                 commit_sha,
-                json.dumps(payload)
+                payload_json
             ))
             logger.info(f"Stored deployment {deployment['id']}")
         except Exception as e:
             logger.error(f"Error storing deployment: {str(e)}")
 
-# Handle merged PR webhook
-def handle_pull_request_event(cursor, payload):
+# Handle merged PR webhook; returns the args for update_first_commit_at, to be queued once the row is committed
+def handle_pull_request_event(cursor, payload, payload_json):
     if payload['action'] != 'closed' or not payload['pull_request']['merged']:
-        return
+        return None
 
     pr = payload['pull_request']
     repo_id = payload['repository']['id']
     pr_id = pr['id']
     commit_sha = pr.get('merge_commit_sha', '')
-    created_at = datetime.strptime(pr['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-    merged_at = datetime.strptime(pr['merged_at'], '%Y-%m-%dT%H:%M:%SZ')
+    created_at = parse_github_timestamp(pr['created_at'])
+    merged_at = parse_github_timestamp(pr['merged_at'])
     pr_name = pr.get('title', '')
 
-    # Try to get first commit time from GitHub API
-    try:
-        commits_url = pr['_links']['commits']['href']
-        token = get_installation_token()
-        commits_resp = requests.get(commits_url, headers={
-            "Authorization": f"Bearer {token}",
-            "Accept": "application/vnd.github+json"
-        })
-        commits = commits_resp.json()
-        if commits and isinstance(commits, list):
-            first_commit_at = min(
-                datetime.strptime(c['commit']['author']['date'], '%Y-%m-%dT%H:%M:%SZ')
-                for c in commits
-            )
-        else:
-            first_commit_at = created_at
-    except Exception as e:
-        logger.warning(f"Could not fetch commits for PR {pr_id}: {e}")
-        first_commit_at = created_at
+    # created_at stands in until the background lookup fills in the first commit time
+    first_commit_at = created_at
 
     try:
-        cursor.execute("""
-            INSERT INTO pull_requests (
-                repo_id, pr_id, merged_at, created_at,
-                first_commit_at, base_branch, commit_sha, pr_name, payload
-            )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (pr_id) DO UPDATE SET
-                merged_at = EXCLUDED.merged_at,
-                commit_sha = EXCLUDED.commit_sha,
-                pr_name = EXCLUDED.pr_name,
-                first_commit_at = EXCLUDED.first_commit_at,
-                payload = EXCLUDED.payload
-        """, (
+        execute_prepared(cursor, 'insert_pull_request', INSERT_PULL_REQUEST_SQL, (
             repo_id, pr_id, merged_at, created_at,
-            first_commit_at, pr['base']['ref'], commit_sha, pr_name, json.dumps(payload)
+            first_commit_at, pr['base']['ref'], commit_sha, pr_name, payload_json
         ))
-
-        if commit_sha:
-            link_pr_to_deployment(cursor, repo_id, pr_id, commit_sha)
-
     except Exception as e:
         logger.error(f"Error storing PR: {str(e)}")
+        return None
+
+    commits_url = pr.get('_links', {}).get('commits', {}).get('href')
+    return (repo_id, pr_id, commit_sha, commits_url) if commits_url else None
 
 # Handle GitHub issues event (treated as incidents)
-def handle_issues_event(cursor, payload):
+def handle_issues_event(cursor, payload, payload_json):
     if payload['action'] not in ['opened', 'closed', 'reopened', 'labeled', 'unlabeled']:
         return
 
     issue = payload['issue']
     repo_id = payload['repository']['id']
     issue_id = issue['id']
-    created_at = datetime.strptime(issue['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-    closed_at = datetime.strptime(issue['closed_at'], '%Y-%m-%dT%H:%M:%SZ') if issue.get('closed_at') else None
+    created_at = parse_github_timestamp(issue['created_at'])
+    closed_at = parse_github_timestamp(issue['closed_at']) if issue.get('closed_at') else None
     is_incident = True
 
     try:
-        cursor.execute("""
-            INSERT INTO incidents (
-                repo_id, issue_id, created_at, closed_at,
-                is_incident, payload
-            )
-            VALUES (%s, %s, %s, %s, %s, %s)
-            ON CONFLICT (issue_id) DO UPDATE SET
-                closed_at = EXCLUDED.closed_at,
-                is_incident = EXCLUDED.is_incident,
-                payload = EXCLUDED.payload
-        """, (
-            repo_id, issue_id, created_at, closed_at, is_incident, json.dumps(payload)
+        execute_prepared(cursor, 'insert_incident', INSERT_INCIDENT_SQL, (
+            repo_id, issue_id, created_at, closed_at, is_incident, payload_json
         ))
 
         # Link issue to nearest deployment
-        cursor.execute("""
-            UPDATE incidents
-            SET deployment_id = (
-                SELECT deployment_id
-                FROM deployments
-                WHERE repo_id = %s AND
-                      created_at BETWEEN %s - INTERVAL '24 HOURS' AND %s + INTERVAL '24 HOURS'
-                ORDER BY ABS(EXTRACT(EPOCH FROM (created_at - %s)))
-                LIMIT 1
-            )
-            WHERE issue_id = %s
-        """, (repo_id, created_at, created_at, created_at, issue_id))
+        execute_prepared(cursor, 'link_incident', LINK_INCIDENT_SQL, (repo_id, created_at, issue_id))
 
         logger.info(f"Inserted incident {issue_id} for repo {repo_id}")
     except Exception as e:
@@ -175,65 +315,55 @@ def handle_issues_event(cursor, payload):
 
 # Endpoint to get DORA metrics summary
 @app.route('/metrics', methods=['GET'])
+@cached_response
 def get_overall_metrics():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        cursor = get_request_cursor()
 
+        # One grouped pass per table instead of five queries per repo
         cursor.execute("""
-            SELECT DISTINCT repo_id FROM (
-                SELECT repo_id FROM deployments
-                UNION
-                SELECT repo_id FROM pull_requests
-                UNION
-                SELECT repo_id FROM incidents
-            ) AS repos
-        """)
-        repos = [row[0] for row in cursor.fetchall()]
-        metrics = []
-
-        for repo_id in repos:
-            cursor.execute("""
-                SELECT COUNT(*) FROM deployments
-                WHERE repo_id = %s AND status='success'
-            """, (repo_id,))
-            successful_deployments = cursor.fetchone()[0]
-
-            cursor.execute("""
-                SELECT COUNT(*) FROM deployments
-                WHERE repo_id = %s
-            """, (repo_id,))
-            total_deployments = cursor.fetchone()[0]
-
-            cursor.execute("""
-                SELECT COUNT(DISTINCT i.deployment_id)
-                FROM incidents i
-                WHERE i.repo_id = %s AND i.is_incident = TRUE AND i.deployment_id IS NOT NULL
-            """, (repo_id,))
-            failed_deployments = cursor.fetchone()[0]
-            failure_rate = (failed_deployments / total_deployments * 100) if total_deployments else 0.0
-
-            cursor.execute("""
-                SELECT COALESCE(
-                    percentile_cont(0.5) WITHIN GROUP (ORDER BY lead_time_hours),
-                    0.0
-                )
+            WITH deploys AS (
+                SELECT
+                    repo_id,
+                    COUNT(*) FILTER (WHERE status = 'success') AS successful,
+                    COUNT(*) AS total
+                FROM deployments
+                GROUP BY repo_id
+            ), failures AS (
+                SELECT
+                    repo_id,
+                    COUNT(DISTINCT deployment_id) AS failed,
+                    percentile_cont(0.5) WITHIN GROUP (
+                        ORDER BY (EXTRACT(EPOCH FROM (closed_at - created_at)) / 3600.0)::float8
+                    ) FILTER (WHERE closed_at IS NOT NULL) AS median_mttr
+                FROM incidents
+                WHERE is_incident = TRUE
+                GROUP BY repo_id
+            ), lead AS (
+                SELECT repo_id, percentile_cont(0.5) WITHIN GROUP (ORDER BY lead_time_hours) AS median_lead_time
                 FROM (
-                    SELECT DISTINCT lead_time_hours
+                    SELECT DISTINCT repo_id, lead_time_hours
                     FROM dora_metrics
-                    WHERE repo_id = %s
                 ) AS distinct_lead_times
-            """, (repo_id,))
-            median_lead_time = cursor.fetchone()[0]
-
-            cursor.execute("""
-                SELECT EXTRACT(EPOCH FROM (closed_at - created_at)) / 3600.0
-                FROM incidents
-                WHERE repo_id = %s AND is_incident = TRUE AND closed_at IS NOT NULL
-            """, (repo_id,))
-            mttrs = [row[0] for row in cursor.fetchall()]
-            median_mttr = median(mttrs) if mttrs else 0.0
+                GROUP BY repo_id
+            )
+            SELECT
+                repo_id,
+                COALESCE(deploys.successful, 0),
+                COALESCE(deploys.total, 0),
+                COALESCE(failures.failed, 0),
+                COALESCE(lead.median_lead_time, 0.0),
+                COALESCE(failures.median_mttr, 0.0)
+            FROM repositories
+            LEFT JOIN deploys USING (repo_id)
+            LEFT JOIN failures USING (repo_id)
+            LEFT JOIN lead USING (repo_id)
+            ORDER BY repo_id
+        """)
 
+        metrics = []
+        for repo_id, successful_deployments, total_deployments, failed_deployments, median_lead_time, median_mttr in cursor:
+            failure_rate = (failed_deployments / total_deployments * 100) if total_deployments else 0.0
             metrics.append({
                 "repo_id": repo_id,
                 "total_successful_deployments": successful_deployments,
@@ -248,25 +378,86 @@ def get_overall_metrics():
         logger.error(f"Error computing overall metrics: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
+# One job at a time across all gunicorn workers: idx_metric_jobs_active admits a single queued/running
+# metric_jobs row, so a /calculate while one is pending gets that job's id instead of starting another
+_calculate_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='calculate')
+# A job still active after this long belonged to a worker that died mid-run; it no longer blocks new ones
+METRIC_JOB_TIMEOUT = '6 hours'
+
+def run_metrics_job(job_id):
+    """Background job for /calculate; progress is recorded in metric_jobs"""
+    try:
+        with db_conn() as conn, conn.cursor() as cursor:
+            cursor.execute("UPDATE metric_jobs SET status = 'running' WHERE id = %s", (job_id,))
+            conn.commit()
+        results = process_metrics(raise_errors=True, force=True)
+        status, processed, error = 'done', len(results), None
+    except Exception as e:
+        logger.error(f"Metrics job {job_id} failed: {str(e)}")
+        status, processed, error = 'failed', None, str(e)
+    try:
+        with db_conn() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE metric_jobs
+                SET status = %s, processed = %s, error = %s, finished_at = NOW()
+                WHERE id = %s
+            """, (status, processed, error, job_id))
+            conn.commit()
+    except Exception as e:
+        # Executor futures are never awaited, so log rather than let this vanish
+        logger.error(f"Could not record outcome of metrics job {job_id}: {str(e)}")
 
-# Manually trigger DORA metric calculation
+# Manually trigger DORA metric calculation; returns at once with a job id to poll
 @app.route('/calculate', methods=['POST'])
 def calculate_now():
     try:
-        process_metrics()
-        return jsonify({"status": "Metrics calculated"}), 200
+        cursor = get_request_cursor()
+        cursor.execute("""
+            UPDATE metric_jobs SET status = 'failed', error = 'abandoned', finished_at = NOW()
+            WHERE status IN ('queued', 'running') AND requested_at < NOW() - %s::interval
+        """, (METRIC_JOB_TIMEOUT,))
+        cursor.execute("INSERT INTO metric_jobs DEFAULT VALUES ON CONFLICT DO NOTHING RETURNING id")
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute("SELECT id, status FROM metric_jobs WHERE status IN ('queued', 'running')")
+            active = cursor.fetchone()
+            cursor.connection.commit()
+            if active:
+                return jsonify({"status": active[1], "id": active[0]}), 202
+            return jsonify({'error': 'Metrics job finished concurrently; retry'}), 409
+        job_id = row[0]
+        cursor.connection.commit()
+        _calculate_executor.submit(run_metrics_job, job_id)
+        return jsonify({"status": "queued", "id": job_id}), 202
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/calculate/<int:job_id>', methods=['GET'])
+def calculate_status(job_id):
+    cursor = get_request_cursor()
+    cursor.execute("""
+        SELECT status, requested_at, finished_at, processed, error
+        FROM metric_jobs
+        WHERE id = %s
+    """, (job_id,))
+    row = cursor.fetchone()
+    if not row:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify({
+        "id": job_id,
+        "status": row[0],
+        "requested_at": row[1],
+        "finished_at": row[2],
+        "processed": row[3],
+        "error": row[4]
+    }), 200
+
 # Show latest deployment, PR, and incident entries
 @app.route('/logs', methods=['GET'])
+@cached_response
 def get_logs():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        cursor = get_request_cursor()
 
         cursor.execute("""
             SELECT deployment_id, repo_id, environment, status, created_at
@@ -295,77 +486,77 @@ def get_logs():
         return jsonify({
             "deployments": [{
                 "deployment_id": d[0], "repo_id": d[1], "environment": d[2],
-                "status": d[3], "created_at": d[4].isoformat()
+                "status": d[3], "created_at": d[4]
             } for d in deployments],
             "pull_requests": [{
                 "pr_id": p[0], "repo_id": p[1],
-                "merged_at": p[2].isoformat() if p[2] else None,
+                "merged_at": p[2],
                 "base_branch": p[3],
                 "pr_name": p[4]
             } for p in prs],
             "incidents": [{
                 "issue_id": i[0], "repo_id": i[1],
-                "created_at": i[2].isoformat(),
-                "closed_at": i[3].isoformat() if i[3] else None,
+                "created_at": i[2],
+                "closed_at": i[3],
                 "is_incident": i[4]
             } for i in incidents]
         }), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
-    finally:
-        cursor.close()
-        conn.close()
 
 # Get 30 recent daily DORA metrics
 @app.route('/daily_metrics', methods=['GET'])
+@cached_response
 def get_daily_metrics():
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT repo_id, metric_date, 
-                   deployment_frequency, 
-                   lead_time_hours,
-                   change_failure_rate,
-                   mttr_hours
-            FROM dora_metrics
-            ORDER BY metric_date DESC
-            LIMIT 30
-        """)
-        results = [{
-            "repo_id": row[0],
-            "date": row[1].isoformat(),
-            "deployment_frequency": row[2],
-            "lead_time_hours": row[3],
-            "change_failure_rate": row[4],
-            "mttr_hours": row[5]
-        } for row in cursor.fetchall()]
-        return jsonify({"daily_metrics": results}), 200
-    finally:
-        cursor.close()
-        conn.close()
+    cursor = get_request_cursor()
+    cursor.execute("""
+        SELECT repo_id, metric_date, 
+               deployment_frequency, 
+               lead_time_hours,
+               change_failure_rate,
+               mttr_hours
+        FROM dora_metrics
+        ORDER BY metric_date DESC
+        LIMIT 30
+    """)
+    results = [{
+        "repo_id": row[0],
+        "date": row[1],
+        "deployment_frequency": row[2],
+        "lead_time_hours": row[3],
+        "change_failure_rate": row[4],
+        "mttr_hours": row[5]
+    } for row in cursor.fetchall()]
+    return jsonify({"daily_metrics": results}), 200
 
 # GitHub webhook handler
 @app.route('/webhook', methods=['POST'])
 def webhook():
+    # Read the body once: the same bytes are signed and parsed
+    raw_body = request.get_data(cache=False)
     signature = request.headers.get('X-Hub-Signature-256')
-    if not signature or not verify_signature(request.data, signature):
+    if not signature or not verify_webhook_signature(raw_body, signature):
         return jsonify({'error': 'Invalid signature'}), 401
 
     event_type = request.headers.get('X-GitHub-Event')
-    payload = request.json
+    try:
+        payload = orjson.loads(raw_body)
+    except orjson.JSONDecodeError:
+        return jsonify({'error': 'Malformed JSON payload'}), 400
+    # The body is already valid UTF-8 JSON; store it as-is instead of re-serializing the parsed payload
+    payload_json = raw_body.decode()
 
+    first_commit_lookup = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        cursor = get_request_cursor()
 
         if event_type == 'deployment_status':
-            handle_deployment_event(cursor, payload)
+            handle_deployment_event(cursor, payload, payload_json)
         elif event_type == 'pull_request':
-            handle_pull_request_event(cursor, payload)
+            first_commit_lookup = handle_pull_request_event(cursor, payload, payload_json)
         elif event_type == 'issues':
-            handle_issues_event(cursor, payload)
+            handle_issues_event(cursor, payload, payload_json)
 
         repo_id = payload['repository']['id']
         metric_date = datetime.utcnow().date()
@@ -375,15 +566,16 @@ def webhook():
         process_repo_metrics(cursor, repo_id, start_time, end_time, metric_date)
 
         cursor.execute("UPDATE sync_state SET last_webhook_at = NOW() WHERE id = 1")
-        conn.commit()
+        cursor.connection.commit()
+        # This worker's cached reads are now stale; other workers catch up within the TTL
+        clear_response_cache()
+        if first_commit_lookup:
+            _first_commit_executor.submit(update_first_commit_at, *first_commit_lookup)
         return jsonify({'status': 'success'}), 200
 
     except Exception as e:
         logger.error(f"Webhook processing failed: {str(e)}")
         return jsonify({'error': str(e)}), 500
-    finally:
-        cursor.close()
-        conn.close()
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -394,5 +586,7 @@ def home():
     return "Dora Metrics Webhook Server is running!", 200
 
 if __name__ == '__main__':
+    # Local development only; main.py serves the app under gunicorn (gthread workers), e.g.
+    #   gunicorn -w 4 -k gthread --threads 8 -b 0.0.0.0:5000 webhook_server:app
     initialize_db()
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
@@ -1,7 +1,7 @@
 import os
 import argparse
 from datetime import datetime
-from db_utils import get_db_connection
+from db_utils import get_db_connection, release_db_connection
 from metrics_processor import process_metrics
 
 def parse_args():
@@ -24,24 +24,17 @@ def parse_args():
     return parser.parse_args()
 
 def delete_metrics(cursor, repo_id=None, start_date=None, end_date=None):
-    conditions = []
-    params = []
-    if repo_id:
-        conditions.append("repo_id = %s")
-        params.append(repo_id)
-    if start_date:
-        conditions.append("metric_date >= %s")
-        params.append(start_date)
-    if end_date:
-        conditions.append("metric_date <= %s")
-        params.append(end_date)
-
-    where_clause = ""
-    if conditions:
-        where_clause = "WHERE " + " AND ".join(conditions)
-
-    sql = f"DELETE FROM dora_metrics {where_clause};"
-    cursor.execute(sql, tuple(params))
+    # Fixed-shape SQL text: an unset filter binds NULL and drops out instead of changing the statement
+    cursor.execute("""
+        DELETE FROM dora_metrics
+        WHERE (%(repo_id)s::bigint IS NULL OR repo_id = %(repo_id)s)
+          AND (%(start_date)s::date IS NULL OR metric_date >= %(start_date)s)
+          AND (%(end_date)s::date IS NULL OR metric_date <= %(end_date)s);
+    """, {
+        'repo_id': repo_id or None,
+        'start_date': start_date,
+        'end_date': end_date
+    })
     deleted = cursor.rowcount
     print(f"🗑️  Deleted {deleted} rows from dora_metrics")
     return deleted
@@ -71,7 +64,7 @@ def main():
         print(f"❌ Error during recalculation: {e}")
     finally:
         cursor.close()
-        conn.close()
+        release_db_connection(conn)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
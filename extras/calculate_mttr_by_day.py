@@ -1,7 +1,8 @@
 import os
+import sys
 import psycopg2
 from dotenv import load_dotenv
-from db_utils import get_db_connection  # uses your existing function
+from db_utils import get_db_connection, release_db_connection  # uses your existing function
 
 load_dotenv()
 
@@ -14,7 +15,7 @@ def calculate_mttr_per_day():
         
         cursor.execute("""
             SELECT 
-                DATE(created_at) AS day,
+                (created_at AT TIME ZONE 'UTC')::date AS day,
                 ROUND(AVG(EXTRACT(EPOCH FROM (closed_at - created_at)) / 3600.0), 2) AS mttr_hours,
                 COUNT(*) AS incidents_count
             FROM incidents
@@ -22,17 +23,18 @@ def calculate_mttr_per_day():
                 repo_id = %s 
                 AND is_incident = TRUE 
                 AND closed_at IS NOT NULL
-            GROUP BY DATE(created_at)
+            GROUP BY day
             ORDER BY day;
         """, (REPO_ID,))
         
-        results = cursor.fetchall()
-        
         print("\n📊 MTTR Per Day (by incident created_at date):")
         print("------------------------------------------------")
-        if results:
-            for day, mttr_hours, incidents_count in results:
-                print(f"📅 {day} | 🛠 Incidents: {incidents_count} | ⏱️ MTTR: {mttr_hours} hrs")
+        if cursor.rowcount:
+            # One write for the whole report instead of a print (and stdout flush) per day
+            sys.stdout.write("\n".join(
+                f"📅 {day} | 🛠 Incidents: {incidents_count} | ⏱️ MTTR: {mttr_hours} hrs"
+                for day, mttr_hours, incidents_count in cursor
+            ) + "\n")
         else:
             print("No incidents found for this repo.")
         
@@ -40,7 +42,7 @@ def calculate_mttr_per_day():
         print(f"❌ Error calculating MTTR: {e}")
     finally:
         if cursor: cursor.close()
-        if conn: conn.close()
+        if conn: release_db_connection(conn)
 
 if __name__ == "__main__":
     calculate_mttr_per_day()
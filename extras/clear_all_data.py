@@ -1,5 +1,5 @@
 import logging
-from db_utils import get_db_connection
+from db_utils import get_db_connection, release_db_connection, initialize_db
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -9,14 +9,10 @@ def clear_all_tables():
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
-        logger.info("⚠️  Deleting all rows from tables...")
+        logger.info("⚠️  Truncating all tables...")
         
-        # Delete in dependency order to satisfy FK constraints
-        cursor.execute("DELETE FROM deployment_prs;")
-        cursor.execute("DELETE FROM incidents;")
-        cursor.execute("DELETE FROM pull_requests;")
-        cursor.execute("DELETE FROM deployments;")
-        cursor.execute("DELETE FROM dora_metrics;")
+        # CASCADE covers the FK dependencies, so no deletion order is needed
+        cursor.execute("TRUNCATE TABLE deployment_prs, incidents, pull_requests, deployments, dora_metrics, repositories RESTART IDENTITY CASCADE;")
         
         conn.commit()
         logger.info("✅ All tables cleared successfully.")
@@ -25,7 +21,9 @@ def clear_all_tables():
         conn.rollback()
     finally:
         cursor.close()
-        conn.close()
+        release_db_connection(conn)
 
 if __name__ == "__main__":
+    # Creates repositories on a database from before it existed, so the TRUNCATE below can name it
+    initialize_db()
     clear_all_tables()
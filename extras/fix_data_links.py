@@ -1,7 +1,7 @@
 # fix_data_links.py
 
 import psycopg2
-from db_utils import get_db_connection
+from db_utils import get_db_connection, release_db_connection
 
 def fix_data_links():
     conn = get_db_connection()
@@ -30,22 +30,17 @@ def fix_data_links():
     # 3. Link Incidents to Closest Deployment
     print("🚑 Linking incidents to closest deployments...")
     cur.execute("""
-        WITH closest_deployments AS (
-            SELECT i.issue_id, d.deployment_id,
-                ROW_NUMBER() OVER (
-                    PARTITION BY i.issue_id
-                    ORDER BY ABS(EXTRACT(EPOCH FROM (d.created_at - i.created_at)))
-                ) AS rn
+        UPDATE incidents
+        SET deployment_id = closest.deployment_id
+        FROM (
+            SELECT DISTINCT ON (i.issue_id) i.issue_id, d.deployment_id
             FROM incidents i
-            JOIN deployments d ON i.repo_id = d.repo_id
+            JOIN deployments d ON d.repo_id = i.repo_id
+             AND d.created_at BETWEEN i.created_at - INTERVAL '24 HOURS' AND i.created_at + INTERVAL '24 HOURS'
             WHERE i.deployment_id IS NULL
-              AND d.created_at BETWEEN i.created_at - INTERVAL '24 HOURS' AND i.created_at + INTERVAL '24 HOURS'
-        )
-        UPDATE incidents
-        SET deployment_id = closest_deployments.deployment_id
-        FROM closest_deployments
-        WHERE incidents.issue_id = closest_deployments.issue_id
-          AND closest_deployments.rn = 1;
+            ORDER BY i.issue_id, GREATEST(d.created_at, i.created_at) - LEAST(d.created_at, i.created_at)
+        ) AS closest
+        WHERE incidents.issue_id = closest.issue_id;
     """)
 
     # 4. Set closed_at for one incident if none exists
@@ -65,7 +60,7 @@ def fix_data_links():
 
     conn.commit()
     cur.close()
-    conn.close()
+    release_db_connection(conn)
     print("✅ Data fix completed successfully.")
 
 if __name__ == "__main__":
@@ -1,7 +1,7 @@
 import os
-import requests
 import logging
 from dotenv import load_dotenv
+from grafana_client import get_grafana_session
 
 # Load .env variables
 load_dotenv()
@@ -31,7 +31,7 @@ def check_grafana_dashboard():
 
     try:
         logger.info(f"Connecting to Grafana at {grafana_url}")
-        response = requests.get(url, headers=headers)
+        response = get_grafana_session().get(url, headers=headers, timeout=10)
 
         if response.status_code == 200:
             logger.info(f"✅ Dashboard UID '{dashboard_uid}' found in Grafana.")
@@ -1,6 +1,6 @@
 import os
-import requests
 from dotenv import load_dotenv
+from grafana_client import get_grafana_session
 
 # Load .env
 load_dotenv()
@@ -20,7 +20,7 @@ def list_dashboards():
 
     try:
         print(f"Connecting to Grafana at {grafana_url}")
-        response = requests.get(f"{grafana_url}/api/search", headers=headers)
+        response = get_grafana_session().get(f"{grafana_url}/api/search", headers=headers, timeout=10)
 
         if response.status_code == 200:
             dashboards = response.json()
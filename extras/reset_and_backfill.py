@@ -1,5 +1,5 @@
 import logging
-from db_utils import get_db_connection, initialize_db
+from db_utils import get_db_connection, release_db_connection, initialize_db
 from github_backfill import backfill
 from metrics_processor import process_metrics
 
@@ -23,18 +23,20 @@ def clear_all_data():
         cursor.execute("TRUNCATE TABLE pull_requests CASCADE;")
         cursor.execute("TRUNCATE TABLE incidents CASCADE;")
         cursor.execute("TRUNCATE TABLE dora_metrics CASCADE;")
+        cursor.execute("TRUNCATE TABLE repositories;")
         conn.commit()
         logger.info("All tables cleared successfully.")
     except Exception as e:
         logger.error(f"Failed to clear data: {e}")
     finally:
         cursor.close()
-        conn.close()
+        release_db_connection(conn)
 
 def main():
     logger.info("Starting full reset and backfill process...")
-    clear_all_data()
+    # Upgrade first: on a pre-repositories schema the TRUNCATE would fail and roll back the whole clear
     initialize_db()
+    clear_all_data()
     logger.info("Running GitHub backfill...")
     backfill()
     logger.info("Calculating historical DORA metrics...")
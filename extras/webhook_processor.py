@@ -1,67 +1,29 @@
-import hmac
-import hashlib
-import json
-import os
 from flask import Flask, request, jsonify
-from datetime import datetime
-from db_utils import get_db_connection
+from db_utils import get_db_connection, release_db_connection
+from dora_calculations import detect_production_deployment, is_incident_issue, parse_github_timestamp
+from github_auth import verify_webhook_signature
 import psycopg2
 
 app = Flask(__name__)
 
 # Helper Functions
-def verify_signature(payload_body, signature_header):
-    secret = os.getenv('GITHUB_WEBHOOK_SECRET').encode()
-    hash_object = hmac.new(secret, msg=payload_body, digestmod=hashlib.sha256)
-    expected_signature = 'sha256=' + hash_object.hexdigest()
-    return hmac.compare_digest(expected_signature, signature_header)
-
-def is_production_deployment(payload):
-    """Determine if deployment is production"""
-    # Check environment name
-    environment = payload.get('environment', '').lower()
-    if any(prod_term in environment for prod_term in ['prod', 'production', 'live']):
-        return True
-    
-    # Check workflow name
-    workflow_run = payload.get('workflow_run', {})
-    workflow_name = workflow_run.get('name', '').lower() if workflow_run else ''
-    if any(prod_term in workflow_name for prod_term in ['deploy', 'prod', 'release']):
-        return True
-    
-    return False
-
-def link_pr_to_deployment(cursor, repo_id, pr_id, commit_sha):
-    """Link PR to deployment via commit SHA"""
-    try:
-        cursor.execute("""
-            INSERT INTO deployment_prs (deployment_id, pr_id)
-            SELECT deployment_id, %s
-            FROM deployments
-            WHERE 
-                repo_id = %s AND
-                commit_sha = %s
-            ON CONFLICT DO NOTHING
-        """, (pr_id, repo_id, commit_sha))
-    except Exception as e:
-        print(f"Error linking PR to deployment: {str(e)}")
-
-def handle_deployment_event(cursor, payload):
+def handle_deployment_event(cursor, payload, payload_json):
     deployment = payload['deployment']
     status = payload['deployment_status']['state']
     repo_id = payload['repository']['id']
     commit_sha = deployment.get('sha', '')
-    created_at = datetime.strptime(payload['deployment_status']['created_at'], '%Y-%m-%dT%H:%M:%SZ')
+    # GitHub timestamps are ISO-8601; Postgres parses them in the ::timestamptz casts below
+    created_at = payload['deployment_status']['created_at']
     
     # Only store successful production deployments
-    if status == 'success' and is_production_deployment(payload):
+    if status == 'success' and detect_production_deployment(deployment.get('environment', ''), payload):
         try:
             cursor.execute("""
                 INSERT INTO deployments (
                     repo_id, deployment_id, environment, status, 
                     created_at, commit_sha, payload
                 )
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                VALUES (%s, %s, %s, %s, %s::timestamptz, %s, %s)
                 ON CONFLICT (deployment_id) DO UPDATE SET
                     status = EXCLUDED.status,
                     payload = EXCLUDED.payload
@@ -72,12 +34,12 @@ def handle_deployment_event(cursor, payload):
                 status,
                 created_at,
                 commit_sha,
-                json.dumps(payload)
+                payload_json
             ))
         except Exception as e:
             print(f"Error storing deployment: {str(e)}")
 
-def handle_pull_request_event(cursor, payload):
+def handle_pull_request_event(cursor, payload, payload_json):
     if payload['action'] != 'closed' or not payload['pull_request']['merged']:
         return
     
@@ -85,104 +47,127 @@ def handle_pull_request_event(cursor, payload):
     repo_id = payload['repository']['id']
     pr_id = pr['id']
     commit_sha = pr['merge_commit_sha'] if 'merge_commit_sha' in pr else ''
-    created_at = datetime.strptime(pr['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-    merged_at = datetime.strptime(pr['merged_at'], '%Y-%m-%dT%H:%M:%SZ') if pr.get('merged_at') else None
+    created_at = pr['created_at']
+    merged_at = pr.get('merged_at')
     
-    # Get first commit time (approximation)
+    # The webhook's `commits` is normally just a count; use the earliest commit only when a list is embedded
     first_commit_at = created_at  # Default to PR creation time
-    if 'commits' in pr and pr['commits'] > 0:
-        try:
-            # Use the oldest commit in the PR
-            cursor.execute("""
-                SELECT MIN(commit->'commit'->'author'->>'date')::TIMESTAMPTZ
-                FROM jsonb_array_elements(%s) AS commit
-            """, (json.dumps(pr.get('commits', [])),))
-            result = cursor.fetchone()
-            if result and result[0]:
-                first_commit_at = result[0]
-        except:
-            pass
+    if isinstance(pr.get('commits'), list):
+        dates = [
+            parse_github_timestamp(c['commit']['author']['date'])
+            for c in pr['commits']
+            if isinstance(c, dict) and c.get('commit', {}).get('author', {}).get('date')
+        ]
+        if dates:
+            first_commit_at = min(dates)
     
     try:
-        # Insert/update PR
+        # Upsert the PR and link it to its deployment in one round trip
         cursor.execute("""
-            INSERT INTO pull_requests (
-                repo_id, pr_id, merged_at, created_at, 
-                first_commit_at, base_branch, commit_sha, payload
+            WITH ins AS (
+                INSERT INTO pull_requests (
+                    repo_id, pr_id, merged_at, created_at, 
+                    first_commit_at, base_branch, commit_sha, payload
+                )
+                VALUES (
+                    %(repo_id)s, %(pr_id)s, %(merged_at)s::timestamptz, %(created_at)s::timestamptz,
+                    %(first_commit_at)s::timestamptz, %(base_branch)s, %(commit_sha)s, %(payload)s
+                )
+                ON CONFLICT (pr_id) DO UPDATE SET
+                    merged_at = EXCLUDED.merged_at,
+                    commit_sha = EXCLUDED.commit_sha,
+                    payload = EXCLUDED.payload
+                RETURNING pr_id, repo_id, commit_sha
             )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (pr_id) DO UPDATE SET
-                merged_at = EXCLUDED.merged_at,
-                commit_sha = EXCLUDED.commit_sha,
-                payload = EXCLUDED.payload
-        """, (
-            repo_id,
-            pr_id,
-            merged_at,
-            created_at,
-            first_commit_at,
-            pr['base']['ref'],
-            commit_sha,
-            json.dumps(payload)
-        ))
-        
-        # Link PR to deployment
-        if commit_sha:
-            link_pr_to_deployment(cursor, repo_id, pr_id, commit_sha)
+            INSERT INTO deployment_prs (deployment_id, pr_id)
+            SELECT d.deployment_id, ins.pr_id
+            FROM ins
+            JOIN deployments d ON 
+                d.repo_id = ins.repo_id AND
+                d.commit_sha = ins.commit_sha
+            WHERE ins.commit_sha <> ''
+            ON CONFLICT DO NOTHING
+        """, {
+            'repo_id': repo_id,
+            'pr_id': pr_id,
+            'merged_at': merged_at,
+            'created_at': created_at,
+            'first_commit_at': first_commit_at,
+            'base_branch': pr['base']['ref'],
+            'commit_sha': commit_sha,
+            'payload': payload_json
+        })
             
     except Exception as e:
         print(f"Error storing PR: {str(e)}")
 
-def handle_issues_event(cursor, payload):
+def handle_issues_event(cursor, payload, payload_json):
     if payload['action'] not in ['opened', 'closed', 'reopened', 'labeled', 'unlabeled']:
         return
     
     issue = payload['issue']
     repo_id = payload['repository']['id']
     issue_id = issue['id']
-    created_at = datetime.strptime(issue['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-    closed_at = datetime.strptime(issue['closed_at'], '%Y-%m-%dT%H:%M:%SZ') if issue.get('closed_at') else None
+    created_at = issue['created_at']
+    closed_at = issue.get('closed_at')
     
     # Check if incident
-    labels = [label['name'].lower() for label in issue.get('labels', [])]
-    is_incident = any(incident_term in label for label in labels 
-                     for incident_term in ['incident', 'outage', 'failure', 'sev'])
+    is_incident = is_incident_issue(issue.get('labels'))
     
     try:
-        # Insert/update incident
+        # Insert/update incident, linking it to the nearest deployment within 24h in the same statement
         cursor.execute("""
             INSERT INTO incidents (
                 repo_id, issue_id, created_at, closed_at, 
-                is_incident, payload
+                is_incident, deployment_id, payload
+            )
+            VALUES (
+                %(repo_id)s, %(issue_id)s, %(created_at)s::timestamptz, %(closed_at)s::timestamptz,
+                %(is_incident)s,
+                (
+                    -- Closest deployment on each side of the incident, each one index probe, then the nearer of the two
+                    SELECT deployment_id
+                    FROM (
+                        (
+                            SELECT deployment_id, created_at
+                            FROM deployments
+                            WHERE
+                                repo_id = %(repo_id)s AND
+                                created_at <= %(created_at)s::timestamptz AND
+                                created_at >= %(created_at)s::timestamptz - INTERVAL '24 HOURS'
+                            ORDER BY created_at DESC
+                            LIMIT 1
+                        )
+                        UNION ALL
+                        (
+                            SELECT deployment_id, created_at
+                            FROM deployments
+                            WHERE
+                                repo_id = %(repo_id)s AND
+                                created_at > %(created_at)s::timestamptz AND
+                                created_at <= %(created_at)s::timestamptz + INTERVAL '24 HOURS'
+                            ORDER BY created_at
+                            LIMIT 1
+                        )
+                    ) AS nearest
+                    ORDER BY GREATEST(created_at, %(created_at)s::timestamptz) - LEAST(created_at, %(created_at)s::timestamptz)
+                    LIMIT 1
+                ),
+                %(payload)s
             )
-            VALUES (%s, %s, %s, %s, %s, %s)
             ON CONFLICT (issue_id) DO UPDATE SET
                 closed_at = EXCLUDED.closed_at,
                 is_incident = EXCLUDED.is_incident,
+                deployment_id = EXCLUDED.deployment_id,
                 payload = EXCLUDED.payload
-        """, (
-            repo_id,
-            issue_id,
-            created_at,
-            closed_at,
-            is_incident,
-            json.dumps(payload)
-        ))
-        
-        # Try to link to deployment
-        cursor.execute("""
-            UPDATE incidents
-            SET deployment_id = (
-                SELECT deployment_id
-                FROM deployments
-                WHERE 
-                    repo_id = %s AND
-                    created_at BETWEEN %s - INTERVAL '24 HOURS' AND %s + INTERVAL '24 HOURS'
-                ORDER BY ABS(EXTRACT(EPOCH FROM (created_at - %s))) 
-                LIMIT 1
-            )
-            WHERE issue_id = %s
-        """, (repo_id, created_at, created_at, created_at, issue_id))
+        """, {
+            'repo_id': repo_id,
+            'issue_id': issue_id,
+            'created_at': created_at,
+            'closed_at': closed_at,
+            'is_incident': is_incident,
+            'payload': payload_json
+        })
             
     except Exception as e:
         print(f"Error storing incident: {str(e)}")
@@ -190,22 +175,24 @@ def handle_issues_event(cursor, payload):
 @app.route('/webhook', methods=['POST'])
 def handle_webhook():
     signature = request.headers.get('X-Hub-Signature-256')
-    if not signature or not verify_signature(request.data, signature):
+    if not signature or not verify_webhook_signature(request.data, signature):
         return jsonify({'error': 'Invalid signature'}), 401
     
     event_type = request.headers.get('X-GitHub-Event')
     payload = request.json
+    # Stored as received; GitHub's body is already the JSON text the JSONB column needs
+    payload_json = request.get_data(as_text=True)
     
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
         
         if event_type == 'deployment_status':
-            handle_deployment_event(cursor, payload)
+            handle_deployment_event(cursor, payload, payload_json)
         elif event_type == 'pull_request':
-            handle_pull_request_event(cursor, payload)
+            handle_pull_request_event(cursor, payload, payload_json)
         elif event_type == 'issues':
-            handle_issues_event(cursor, payload)
+            handle_issues_event(cursor, payload, payload_json)
         
         conn.commit()
         return jsonify({'status': 'success'}), 200
@@ -214,9 +201,11 @@ def handle_webhook():
         return jsonify({'error': str(e)}), 500
     finally:
         cursor.close()
-        conn.close()
+        release_db_connection(conn)
 
 if __name__ == '__main__':
+    # Serve with gunicorn rather than the single-threaded Werkzeug dev server
     from db_utils import initialize_db
     initialize_db()
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    print("Schema ready. Start the processor with:\n"
+          "  gunicorn -k gthread -w 2 --threads 16 -b 0.0.0.0:5000 webhook_processor:app")